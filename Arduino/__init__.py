@@ -1 +1,4 @@
-from .arduino import Arduino, Shrimp
+from .arduino import Arduino, Shrimp, ArduinoTimeout, PinGroup, ReadCache
+from .recorder import RecordingSerial, ReplaySerial
+from .datalogger import DataLogger
+from .scheduler import CONTROL, SENSING, BULK
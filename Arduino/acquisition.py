@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+NumPy support for block acquisition (Arduino.acquire) and vectorised
+post-processing of the resulting (n_samples, n_pins) arrays.
+"""
+import numpy as np
+
+
+def read_samples(sr, n_samples, n_pins, chunk_size=4096):
+    """
+    Reads n_samples rows of n_pins little endian uint16 readings from a
+    serial object, straight into a (n_samples, n_pins) array.
+    """
+    samples = np.empty((n_samples, n_pins), dtype='<u2')
+    raw = samples.reshape(-1).view(np.uint8)
+    pos = 0
+    while pos < raw.size:
+        data = sr.read(min(chunk_size, raw.size - pos))
+        if not data:
+            raise IOError('Acquisition timed out after {0} of {1} '
+                          'samples.'.format(pos // (2 * n_pins), n_samples))
+        raw[pos:pos + len(data)] = np.frombuffer(data, dtype=np.uint8)
+        pos += len(data)
+    return samples
+
+
+def to_volts(samples, vref=5.0, bits=10, out=None):
+    """
+    Converts ADC readings to volts.
+
+    Input:
+        samples (array): readings, as returned by Arduino.acquire
+        vref (float): ADC reference voltage
+        bits (int): ADC resolution
+        out (array): optional float array to write the result to. It can
+            be samples itself if that is a float array.
+    Output:
+        (array) float32 array of voltages, or out
+    """
+    if out is None:
+        out = np.empty(samples.shape, dtype=np.float32)
+    return np.multiply(samples, vref / (2 ** bits - 1), out=out,
+                       casting='unsafe')
+
+
+def decimate(samples, factor):
+    """
+    Reduces the sample rate by factor, averaging each block of factor
+    consecutive rows. Trailing rows that do not fill a block are dropped.
+    """
+    n = (len(samples) // factor) * factor
+    blocks = samples[:n].reshape((n // factor, factor) + samples.shape[1:])
+    return blocks.mean(axis=1)
+
+
+def moving_average(samples, window, out=None):
+    """
+    Trailing moving average over window rows, along the first axis. The
+    first window - 1 rows average the rows available so far, so that the
+    result has the same shape as samples.
+
+    out is an optional array to write the result to. It can be samples
+    itself, to filter a float array in place.
+    """
+    csum = np.cumsum(samples, axis=0, dtype=np.float64)
+    csum[window:] = csum[window:] - csum[:-window]
+    counts = np.minimum(np.arange(1, len(samples) + 1), window)
+    counts = counts.reshape((-1,) + (1,) * (samples.ndim - 1))
+    np.divide(csum, counts, out=csum)
+    if out is None:
+        return csum
+    out[...] = csum
+    return out
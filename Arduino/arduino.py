@@ -1,24 +1,37 @@
 #!/usr/bin/env python
 import logging
+import binascii
 import itertools
+import numbers
 import platform
 import serial
+import threading
 import time
-from serial.tools import list_ports
-if platform.system() == 'Windows':
-    import _winreg as winreg
-else:
-    import glob
+from .recorder import RecordingSerial
+from .scheduler import Scheduler
 
 
 log = logging.getLogger(__name__)
 
+_now = getattr(time, 'monotonic', time.time)
+
+
+class ArduinoTimeout(IOError):
+
+    """
+    Raised when the board does not answer a command, even after retries.
+    """
+
 
 def enumerate_serial_ports():
     """
     Uses the Win32 registry to return a iterator of serial
         (COM) ports existing on this computer.
     """
+    try:
+        import _winreg as winreg
+    except ImportError:
+        import winreg
     path = 'HARDWARE\\DEVICEMAP\\SERIALCOMM'
     try:
         key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path)
@@ -51,7 +64,82 @@ def build_cmd_str(cmd, args=None):
     return "@{cmd}%{args}$!".format(cmd=cmd, args=args)
 
 
-def find_port(baud, timeout):
+def open_port(port, baud, timeout, fast_connect=False):
+    """
+    Opens a serial port.
+
+    If fast_connect is True, the port is opened with DTR deasserted
+    (pyserial >= 3.0), so that boards with an auto-reset circuit keep
+    running instead of restarting their bootloader. This only works as
+    such on Windows: on Linux and macOS the driver raises DTR when the
+    port is opened, before pyserial can lower it. There, the HUPCL flag
+    of the port is cleared instead, so that DTR stays raised when the
+    port is closed and the next connection does not reset the board
+    (the same as running "stty -F <port> -hupcl" once).
+    """
+    if not fast_connect:
+        return serial.Serial(port, baud, timeout=timeout)
+    sr = serial.Serial()
+    sr.port = port
+    sr.baudrate = baud
+    sr.timeout = timeout
+    sr.dtr = False
+    sr.open()
+    clear_hupcl(sr)
+    return sr
+
+
+def clear_hupcl(sr):
+    """
+    Clears the HUPCL flag of a POSIX serial port, so that closing it
+    does not lower DTR. Returns False where this is not supported.
+    """
+    try:
+        import termios
+        fd = sr.fileno()
+        attrs = termios.tcgetattr(fd)
+        attrs[2] &= ~termios.HUPCL
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except Exception:
+        return False
+    return True
+
+
+def flush_input(sr):
+    """
+    Discards the data received but not read yet, e.g. late answers.
+    """
+    flush = getattr(sr, 'reset_input_buffer',
+                    getattr(sr, 'flushInput', None))
+    if flush:
+        flush()
+
+
+def wait_for_board(sr, wait=3.0, poll=0.05):
+    """
+    Sends the version command every poll seconds until the board
+    answers, for at most wait seconds. Returns True if it answered.
+
+    This replaces a fixed delay after opening a port: a board that was
+    not reset answers right away, and one that was answers as soon as
+    its bootloader hands over to the sketch.
+    """
+    timeout = sr.timeout
+    sr.timeout = poll
+    end = _now() + wait
+    try:
+        while True:
+            if get_version(sr) == 'version':
+                # Drop answers to earlier polls that arrived late.
+                flush_input(sr)
+                return True
+            if _now() >= end:
+                return False
+    finally:
+        sr.timeout = timeout
+
+
+def find_port(baud, timeout, fast_connect=False):
     """
     Find the first port that is connected to an arduino with a compatible
     sketch installed.
@@ -59,17 +147,19 @@ def find_port(baud, timeout):
     if platform.system() == 'Windows':
         ports = enumerate_serial_ports()
     elif platform.system() == 'Darwin':
+        from serial.tools import list_ports
         ports = [i[0] for i in list_ports.comports()]
     else:
+        import glob
         ports = glob.glob("/dev/ttyUSB*") + glob.glob("/dev/ttyACM*")
     for p in ports:
         log.debug('Found {0}, testing...'.format(p))
         try:
-            sr = serial.Serial(p, baud, timeout=timeout)
+            sr = open_port(p, baud, timeout, fast_connect)
         except (serial.serialutil.SerialException, OSError) as e:
             log.debug(str(e))
             continue
-        time.sleep(2)
+        wait_for_board(sr)
         version = get_version(sr)
         if version != 'version':
             log.debug('Bad version {0}. This is not a Shrimp/Arduino!'.format(
@@ -82,6 +172,50 @@ def find_port(baud, timeout):
     return None
 
 
+def parse_pulse_stats(line):
+    """
+    Parses the "mean median min max valid" response of the psn / psm
+    commands. Returns None if the response is malformed.
+    """
+    try:
+        mean, median, lo, hi, valid = line.split()
+        valid = int(valid)
+    except ValueError:
+        return None
+    if not valid:
+        return dict(mean=None, median=None, min=None, max=None, valid=0)
+    return dict(mean=float(mean), median=float(median), min=int(lo),
+                max=int(hi), valid=valid)
+
+
+def pwm_samples(samples):
+    """
+    Converts a waveform to a bytearray of PWM values, clipping values
+    outside of 0-255 unless samples already is a byte buffer.
+    """
+    if isinstance(samples, (bytes, bytearray)):
+        return bytearray(samples)
+    if str(getattr(samples, 'dtype', '')) == 'uint8':
+        return bytearray(samples.tobytes())
+    return bytearray(min(max(int(v), 0), 255) for v in samples)
+
+
+def port_index(port):
+    """
+    Returns the number of an AVR port given as a letter ('B') or as the
+    number returned by digitalPinToPort (A is 1, B is 2...), from A to L.
+    Which of them exist depends on the board: B to D on an Uno, A to L
+    (without I) on a Mega. The sketch ignores writes to other ports.
+    """
+    if isinstance(port, str):
+        if len(port) != 1 or not port.isalpha():
+            raise ValueError('Invalid port {0!r}.'.format(port))
+        port = ord(port.upper()) - ord('A') + 1
+    if not 1 <= port <= 12:
+        raise ValueError('Invalid port {0!r}.'.format(port))
+    return port
+
+
 def get_version(sr):
     cmd_str = build_cmd_str("version")
     try:
@@ -92,28 +226,586 @@ def get_version(sr):
     return sr.readline().replace("\r\n", "")
 
 
+class PinShadow(object):
+
+    """
+    Host-side copy of the last mode / output value sent to each pin, used
+    to skip commands that would not change anything on the board.
+
+    Keys are (kind, pin) tuples, e.g. ('mode', 13), ('out', 13) or
+    ('servo', 9).
+    """
+
+    def __init__(self):
+        self.state = {}
+
+    def update(self, key, value):
+        """
+        Records the value sent for key. Returns False if the board is
+        already known to be in that state, i.e. the command can be skipped.
+        """
+        if key in self.state and self.state[key] == value:
+            return False
+        self.state[key] = value
+        return True
+
+    def invalidate(self, *pins):
+        """
+        Forgets the state of the given pins, or of all pins if none
+        are given.
+        """
+        if not pins:
+            self.state.clear()
+            return
+        for key in list(self.state):
+            if key[1] in pins:
+                del self.state[key]
+
+
+class ReadCache(object):
+
+    """
+    Time-to-live cache of pin readings, shared by all the users of an
+    Arduino object.
+
+    A reading is reused while it is younger than its max age: the global
+    max_age, or the one given in pin_max_age for the pin (keyed by pin
+    number, or by (command, pin) tuples such as ('ar', 0) to set it for
+    one kind of reading only). Callers asking for a pin that is already
+    being read wait for that request instead of sending another one.
+    """
+
+    def __init__(self, max_age=0.01, pin_max_age=None):
+        self.max_age = max_age
+        self.pin_max_age = dict(pin_max_age or {})
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+        self._values = {}
+        self._pending = set()
+        self._cond = threading.Condition()
+
+    def get_max_age(self, key):
+        for k in (key, key[1]):
+            if k in self.pin_max_age:
+                return self.pin_max_age[k]
+        return self.max_age
+
+    def get(self, key, fetch, share=True):
+        """
+        Returns the cached value for key, calling fetch() to read it
+        from the board if it is missing or too old. Fetches are
+        serialised by the board lock, taken by fetch().
+
+        If share is False, a request in flight for key is not waited
+        for. It must be False when the caller holds the board lock, that
+        the request in flight may be waiting for.
+        """
+        waited = False
+        with self._cond:
+            while True:
+                entry = self._values.get(key)
+                if entry and _now() - entry[0] <= self.get_max_age(key):
+                    if waited:
+                        self.shared += 1
+                    else:
+                        self.hits += 1
+                    return entry[1]
+                if key not in self._pending or not share:
+                    break
+                waited = True
+                self._cond.wait()
+            owner = key not in self._pending
+            self._pending.add(key)
+            self.misses += 1
+        try:
+            t = _now()
+            value = fetch()
+            with self._cond:
+                self._values[key] = (t, value)
+            return value
+        finally:
+            if owner:
+                with self._cond:
+                    self._pending.discard(key)
+                    self._cond.notify_all()
+
+    def invalidate(self, *pins):
+        """
+        Drops the cached readings of the given pins, or all of them if no
+        pin is given.
+        """
+        with self._cond:
+            for key in list(self._values):
+                if not pins or key[1] in pins:
+                    del self._values[key]
+
+    def stats(self):
+        """
+        Returns a dict with the number of readings served from the cache
+        (hits), by joining an in-flight request (shared) and by reading
+        the board (misses).
+        """
+        with self._cond:
+            return dict(hits=self.hits, shared=self.shared,
+                        misses=self.misses)
+
+    def reset_stats(self):
+        with self._cond:
+            self.hits = self.shared = self.misses = 0
+
+
+class BoardClock(object):
+
+    """
+    Maps the micros() clock of a board to the host monotonic clock.
+
+    Each call to sync() records a (board time, host time) pair, taken
+    from the ping exchange with the shortest round trip. The drift of the
+    board oscillator is fitted over the last history pairs.
+    """
+
+    WRAP = 2 ** 32
+
+    def __init__(self, history=16):
+        self.history = history
+        self.points = []
+        self.rate = 1.0
+        self._last = None
+        self._wraps = 0
+
+    def unwrap(self, t):
+        """
+        Extends a 32 bit micros() value, which wraps around every 71
+        minutes, to a monotonic microsecond count. Must be called at
+        least once every 35 minutes.
+        """
+        half = self.WRAP // 2
+        if self._last is None:
+            self._last = t
+        elif t < self._last - half:
+            self._wraps += 1
+            self._last = t
+        elif t > self._last + half:
+            # Late sample, taken before the last wrap around.
+            return t + (self._wraps - 1) * self.WRAP
+        elif t > self._last:
+            self._last = t
+        return t + self._wraps * self.WRAP
+
+    def sync(self, board_us, host):
+        """
+        Records that the unwrapped board time board_us (microseconds)
+        corresponds to the host monotonic time host (seconds).
+        """
+        self.points.append((board_us / 1e6, host))
+        del self.points[:-self.history]
+        n = len(self.points)
+        if n < 2:
+            return
+        mean_b = sum(p[0] for p in self.points) / n
+        mean_h = sum(p[1] for p in self.points) / n
+        var = sum((p[0] - mean_b) ** 2 for p in self.points)
+        if var < 1.0:
+            # Too short a span to tell drift from jitter.
+            return
+        cov = sum((p[0] - mean_b) * (p[1] - mean_h) for p in self.points)
+        self.rate = cov / var
+
+    @property
+    def drift(self):
+        """
+        Relative drift of the board clock, e.g. 1e-4 if it runs 100 ppm
+        slow compared to the host.
+        """
+        return self.rate - 1.0
+
+    @property
+    def offset(self):
+        """
+        Host time (seconds) corresponding to the board time 0.
+        """
+        if not self.points:
+            return None
+        board, host = self.points[-1]
+        return host - board * self.rate
+
+    def to_host(self, board_us):
+        """
+        Converts an unwrapped board time (microseconds) to the host
+        monotonic clock (seconds).
+        """
+        if not self.points:
+            raise ValueError('The board clock is not synchronised.')
+        board, host = self.points[-1]
+        return host + (board_us / 1e6 - board) * self.rate
+
+
+class RTTEstimator(object):
+
+    """
+    Estimates the round trip time of the link to set read timeouts, as
+    TCP does (RFC 6298): a smoothed RTT plus four times its mean
+    deviation, bounded by min_timeout and max_timeout.
+    """
+
+    def __init__(self, max_timeout=2.0, min_timeout=0.05, alpha=0.125,
+                 beta=0.25):
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self.alpha = alpha
+        self.beta = beta
+        self.srtt = None
+        self.rttvar = None
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.
+        else:
+            self.rttvar += self.beta * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.alpha * (rtt - self.srtt)
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            return self.max_timeout
+        return min(max(self.srtt + 4 * self.rttvar, self.min_timeout),
+                   self.max_timeout)
+
+
 class Arduino(object):
 
-    def __init__(self, baud=9600, port=None, timeout=2, sr=None):
+    # Commands that can safely be sent again when their response is lost.
+    IDEMPOTENT = frozenset(('version', 'ar', 'dr', 'pi', 'ps', 'psn', 'psm',
+                            'cap', 'sva', 'svr', 'eer', 'sz', 'tm', 'mcn',
+                            'wvs', 'pr', 'pmap', 'eed', 'bde', 'bdl'))
+    # Fixed response timeouts (seconds) of the commands whose execution
+    # time on the board is not negligible. pulseIn() waits up to 1 s.
+    TIMEOUTS = dict(pi=1.5, ps=1.5)
+    # Expected length in bytes of the responses, a reading with its
+    # timestamp by default, to add their transmission time to timeouts.
+    REPLY_BYTES = dict(psn=40, psm=40, st=40, bdl=40, pmap=8)
+    DEFAULT_REPLY_BYTES = 20
+    # Notes per tone command sent by Melody().
+    MELODY_CHUNK = 4
+
+    def __init__(self, baud=9600, port=None, timeout=2, sr=None, record=None,
+                 shadow=False, read_cache=None, fast_connect=False,
+                 retries=2, rate_limits=None):
         """
         Initializes serial communication with Arduino if no connection is
         given. Attempts to self-select COM port, if not specified.
+
+        Responses are waited for according to the measured round trip
+        time, timeout being the upper bound. Reads that can safely be
+        repeated are retried up to retries times, then ArduinoTimeout is
+        raised. Per command timeouts can be set in the timeouts dict.
+
+        If fast_connect is True, the port is opened without resetting the
+        board where possible, and the board is polled until it answers
+        instead of waiting for a fixed delay.
+
+        If record is a file path, all the traffic with the board is
+        logged to it (see Arduino.recorder.ReplaySerial to play it back).
+
+        If shadow is True, the last mode and output value of each pin is
+        tracked and commands that would not change them are not sent.
+        Call invalidate_shadow() whenever the board is reset.
+
+        read_cache enables caching of analogRead() / digitalRead()
+        results. It is either a ReadCache or a max age in seconds.
+
+        Threads sharing the board are served by priority class (see
+        Arduino.scheduler): control commands first, then readings, then
+        bulk transfers. rate_limits optionally maps classes to a maximum
+        number of commands per second.
         """
         if not sr:
             if not port:
-                sr = find_port(baud, timeout)
+                sr = find_port(baud, timeout, fast_connect)
                 if not sr:
                     raise ValueError("Could not find port.")
             else:
-                sr = serial.Serial(port, baud, timeout=timeout)
+                sr = open_port(port, baud, timeout, fast_connect)
+                if fast_connect and not wait_for_board(sr):
+                    log.warning('No answer from the board on {0}.'.format(
+                        port))
+        if record:
+            sr = RecordingSerial(sr, record)
         sr.flush()
         self.sr = sr
+        self.shadow = PinShadow() if shadow else None
+        if read_cache is not None and not isinstance(read_cache, ReadCache):
+            read_cache = ReadCache(read_cache)
+        self.read_cache = read_cache
+        self.clock = BoardClock()
+        self.stamp_readings = False
+        self.last_timestamp = None
+        self.last_acquire_late = None
+        self.rtt = RTTEstimator(timeout or 2.0)
+        self.timeouts = dict(self.TIMEOUTS)
+        self.retries = retries
+        self._busy_until = 0
+        self._port_map = {}
+        # The lock is held for each exchange with the board, so that
+        # several threads can share it.
+        self.scheduler = Scheduler(rate_limits)
+        self.lock = self.scheduler.lock
         self.SoftwareSerial = SoftwareSerial(self)
         self.Servos = Servos(self)
         self.EEPROM = EEPROM(self)
+        self.Macros = Macros(self)
+        self.Waveform = Waveform(self)
+        self.Bindings = Bindings(self)
+
+    def _send(self, cmd, args=None):
+        cmd_str = build_cmd_str(cmd, args)
+        with self.scheduler.transaction(self.scheduler.priority(cmd)):
+            try:
+                self.sr.write(cmd_str)
+                self.sr.flush()
+            except:
+                pass
+
+    def _byte_time(self):
+        """
+        Returns the transmission time of a byte on the link, 0 if the baud
+        rate is unknown.
+        """
+        try:
+            return 10. / float(getattr(self.sr, 'baudrate', None))
+        except (TypeError, ValueError, ZeroDivisionError):
+            return 0.
+
+    def _readline(self, timeout):
+        """
+        Reads a response line, waiting at most timeout seconds, plus the
+        time the board is known to be busy. Returns None if no complete
+        line arrived in time, once the rest of the late response is
+        discarded (see _drain).
+        """
+        timeout += max(self._busy_until - _now(), 0)
+        if self.sr.timeout != timeout:
+            self.sr.timeout = timeout
+        rd = self.sr.readline()
+        if not rd.endswith('\n'):
+            self._drain(rd)
+            return None
+        return rd.replace("\r\n", "")
+
+    def _drain(self, partial, idle=None):
+        """
+        Discards a response that timed out, so that it is not read as the
+        answer to the next command: the input is read until the link has
+        been idle for the time a response can take to start or, after a
+        partial line, for a few bytes, unless another idle time is given.
+        Falls back to discarding the input already received if the serial
+        object cannot tell its size.
+        """
+        if getattr(self.sr, 'in_waiting', None) is None:
+            flush_input(self.sr)
+            return
+        if idle is None:
+            if partial:
+                idle = max(5 * self._byte_time(), 0.01)
+            else:
+                idle = self.rtt.timeout
+        last = _now()
+        while _now() - last < idle:
+            waiting = self.sr.in_waiting
+            if waiting:
+                self.sr.read(waiting)
+                last = _now()
+            else:
+                time.sleep(min(idle / 4, 0.005))
+
+    def _query(self, cmd, args=None, timeout=None, retries=None,
+               reply_bytes=None):
+        """
+        Sends a command and returns its response line.
+
+        Unless a timeout is given or set in self.timeouts, the response
+        is waited for according to the measured round trip time, doubled
+        on each retry, plus the transmission time of reply_bytes bytes
+        (REPLY_BYTES by default). Only idempotent commands are retried by
+        default; the others wait for the full configured timeout instead.
+        A response that timed out is drained before the command is sent
+        again, so that a retry is never answered by it.
+        Raises ArduinoTimeout if no response arrived.
+        """
+        if retries is None:
+            retries = self.retries if cmd in self.IDEMPOTENT else 0
+        if timeout is None:
+            timeout = self.timeouts.get(cmd)
+        adaptive = timeout is None
+        if adaptive and not retries:
+            timeout = self.rtt.max_timeout
+            adaptive = False
+        if reply_bytes is None:
+            reply_bytes = self.REPLY_BYTES.get(cmd, self.DEFAULT_REPLY_BYTES)
+        byte_time = self._byte_time()
+        with self.scheduler.transaction(self.scheduler.priority(cmd)):
+            for attempt in range(retries + 1):
+                if attempt:
+                    log.debug('No answer to {0}, retrying.'.format(cmd))
+                t0 = _now()
+                self._send(cmd, args)
+                if adaptive:
+                    rd = self._readline(min(
+                        self.rtt.timeout * 2 ** attempt,
+                        self.rtt.max_timeout) + reply_bytes * byte_time)
+                else:
+                    rd = self._readline(timeout)
+                if rd is not None:
+                    # Karn's algorithm: retried exchanges are not measured.
+                    # The transmission of the response is not part of the
+                    # latency being estimated.
+                    if adaptive and not attempt:
+                        self.rtt.update(max(
+                            _now() - t0 - (len(rd) + 2) * byte_time, 0))
+                    return rd
+        raise ArduinoTimeout('No answer from the board to {0}.'.format(
+            build_cmd_str(cmd, args)))
 
     def version(self):
-        return get_version(self.sr)
+        return self._query("version")
+
+    def board_stats(self, reset=False):
+        """
+        Returns the performance counters of the sketch, since it started
+        or since the last reset, as a dict:
+           loops, loop_mean_us, loop_max_us: iterations of the sketch main
+               loop, and their mean / longest duration in microseconds
+           rx_overflows: commands dropped for not fitting the 64 byte
+               command buffer
+           parse_errors: malformed or unknown commands
+           rx_timeouts: partial commands dropped after 1 s without data
+           free_ram: bytes between the heap and the stack
+           commands: {name: (count, total execution time in us)}
+        Returns None if the response was malformed.
+        inputs:
+           reset: reset the counters once they are read
+        """
+        # A lost answer to a resetting request must not be retried: the
+        # counters would be gone.
+        with self.lock:
+            header = self._query("st", (1 if reset else 0,),
+                                 retries=0 if reset else self.retries)
+            try:
+                (loops, elapsed_ms, loop_max, overflows, errors, timeouts,
+                 free_ram, n) = map(int, header.split())
+            except ValueError:
+                return None
+            commands = {}
+            for i in range(n):
+                rd = self._readline(self.rtt.timeout)
+                if rd is None:
+                    raise ArduinoTimeout('No answer from the board to st.')
+                try:
+                    name, count, time_us = rd.split()
+                    commands[name] = (int(count), int(time_us))
+                except ValueError:
+                    return None
+        return dict(loops=loops,
+                    loop_mean_us=1000. * elapsed_ms / loops if loops else None,
+                    loop_max_us=loop_max, rx_overflows=overflows,
+                    parse_errors=errors, rx_timeouts=timeouts,
+                    free_ram=free_ram, commands=commands)
+
+    def enable_timestamps(self, enable=True):
+        """
+        Makes the board send the micros() time at which each sample was
+        taken along with analogRead, digitalRead, pulseIn and pulseIn_set
+        readings. The time of the latest reading is then available as
+        last_timestamp (board microseconds) and last_sample_time (host
+        monotonic clock, once sync_clock() was called).
+        """
+        self._send("tsm", (1 if enable else 0,))
+        self.stamp_readings = enable
+
+    def _strip_timestamp(self, rd):
+        """
+        Removes the board timestamp that follows readings when timestamps
+        are enabled, keeping it in last_timestamp.
+        """
+        if self.stamp_readings:
+            parts = rd.split()
+            if len(parts) == 2 and parts[1].isdigit():
+                self.last_timestamp = self.clock.unwrap(int(parts[1]))
+                return parts[0]
+        return rd
+
+    @property
+    def last_sample_time(self):
+        """
+        Host monotonic time at which the latest timestamped reading was
+        sampled by the board.
+        """
+        if self.last_timestamp is None:
+            return None
+        return self.clock.to_host(self.last_timestamp)
+
+    def sync_clock(self, pings=8):
+        """
+        Estimates the offset and drift of the board clock by exchanging
+        pings with it. Call it periodically (at least every 35 minutes)
+        to follow the drift.
+
+        inputs:
+           pings: number of exchanges, the one with the shortest round
+                  trip is kept
+        returns:
+           round trip time of the kept exchange (seconds), which bounds
+           the uncertainty of the estimate, or None if the board did not
+           answer
+        """
+        cmd_str = build_cmd_str("tm")
+        # Transmission time of a byte, to account for the request and
+        # response lengths being different.
+        byte_time = self._byte_time()
+        best = None
+        timed_out = False
+        for i in range(pings):
+            with self.lock:
+                # A stale response would be taken for an instant answer.
+                flush_input(self.sr)
+                t0 = _now()
+                self._send("tm")
+                board = self._readline(
+                    self.rtt.timeout +
+                    self.DEFAULT_REPLY_BYTES * byte_time)
+                t1 = _now()
+            if board is None:
+                timed_out = True
+                continue
+            if timed_out:
+                # The response may be the late one of the previous ping.
+                timed_out = False
+                continue
+            if not board.isdigit():
+                continue
+            rtt = t1 - t0
+            if best is None or rtt < best[0]:
+                wire = (len(cmd_str) + len(board) + 2) * byte_time
+                host = t0 + len(cmd_str) * byte_time + (rtt - wire) / 2
+                best = (rtt, int(board), host)
+        if best is None:
+            return None
+        rtt, board, host = best
+        self.clock.sync(self.clock.unwrap(board), host)
+        return rtt
+
+    def invalidate_shadow(self, *pins):
+        """
+        Forgets the known state of the given pins (all pins if none are
+        given), so that the next command for them is always sent.
+        Must be called after the board was reset.
+        """
+        if self.shadow:
+            self.shadow.invalidate(*pins)
+        if self.read_cache:
+            self.read_cache.invalidate(*pins)
 
     def digitalWrite(self, pin, val):
         """
@@ -128,12 +820,11 @@ class Arduino(object):
             pin_ = -pin
         else:
             pin_ = pin
-        cmd_str = build_cmd_str("dw", (pin_,))
-        try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-        except:
-            pass
+        if self.shadow and not self.shadow.update(('out', pin), pin_ > 0):
+            return
+        if self.read_cache:
+            self.read_cache.invalidate(pin)
+        self._send("dw", (pin_,))
 
     def analogWrite(self, pin, val):
         """
@@ -148,12 +839,12 @@ class Arduino(object):
             val = 255
         elif val < 0:
             val = 0
-        cmd_str = build_cmd_str("aw", (pin, val))
-        try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-        except:
-            pass
+        if self.shadow:
+            # analogWrite() also switches the pin to OUTPUT on the board.
+            self.shadow.update(('mode', pin), True)
+            if not self.shadow.update(('out', pin), ('aw', val)):
+                return
+        self._send("aw", (pin, val))
 
     def analogRead(self, pin):
         """
@@ -164,18 +855,62 @@ class Arduino(object):
         returns:
            value: integer from 1 to 1023
         """
-        cmd_str = build_cmd_str("ar", (pin,))
-        try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-        except:
-            pass
-        rd = self.sr.readline().replace("\r\n", "")
+        if self.read_cache:
+            return self.read_cache.get(
+                ('ar', pin), lambda: self._read_pin("ar", pin),
+                share=not self.lock.owned())
+        return self._read_pin("ar", pin)
+
+    def _read_pin(self, cmd, pin):
+        rd = self._strip_timestamp(self._query(cmd, (pin,)))
         try:
             return int(rd)
         except:
             return 0
 
+    def acquire(self, pins, n_samples, rate_hz):
+        """
+        Samples analog pins at a fixed rate, timed by the board, and
+        returns the readings as a NumPy array (requires numpy).
+        inputs:
+           pins : analog pin number, or list of up to 6 pin numbers
+           n_samples : number of samples to take on each pin
+           rate_hz : sampling rate
+        returns:
+           uint16 array of shape (n_samples, len(pins))
+
+        Readings are sent as 2 bytes each, so rate_hz * len(pins) must
+        stay below baud / 20 (480 at 9600 baud): the number of samples
+        the board could not take on time is kept in last_acquire_late.
+        See Arduino.acquisition for post-processing helpers.
+        """
+        from .acquisition import read_samples
+        if isinstance(pins, int):
+            pins = [pins]
+        if not 1 <= len(pins) <= 6:
+            raise ValueError('acquire() supports 1 to 6 pins.')
+        period = int(round(1e6 / rate_hz))
+        with self.lock:
+            self._send("acq", [period, n_samples] + list(pins))
+            self.sr.timeout = self.rtt.timeout + 2. / rate_hz
+            try:
+                samples = read_samples(self.sr, n_samples, len(pins))
+            except IOError:
+                # The board may still be sending the rest of the samples
+                # and the count of late ones.
+                self._drain(True, idle=self.sr.timeout)
+                flush_input(self.sr)
+                raise
+            rd = self._readline(self.rtt.timeout)
+        try:
+            self.last_acquire_late = int(rd)
+        except (TypeError, ValueError):
+            self.last_acquire_late = None
+        if self.last_acquire_late:
+            log.warning('{0} of {1} samples were taken late.'.format(
+                self.last_acquire_late, n_samples))
+        return samples
+
     def pinMode(self, pin, val):
         """
         Sets I/O mode of pin
@@ -187,12 +922,14 @@ class Arduino(object):
             pin_ = -pin
         else:
             pin_ = pin
-        cmd_str = build_cmd_str("pm", (pin_,))
-        try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-        except:
-            pass
+        if self.shadow:
+            if not self.shadow.update(('mode', pin), pin_ > 0):
+                return
+            # The output latch / pull-up depends on the mode.
+            self.shadow.state.pop(('out', pin), None)
+        if self.read_cache:
+            self.read_cache.invalidate(pin)
+        self._send("pm", (pin_,))
 
     def pulseIn(self, pin, val):
         """
@@ -207,13 +944,8 @@ class Arduino(object):
             pin_ = -pin
         else:
             pin_ = pin
-        cmd_str = build_cmd_str("pi", (pin_,))
-        try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-        except:
-            pass
-        rd = self.sr.readline().replace("\r\n", "")
+        self.invalidate_shadow(pin)
+        rd = self._strip_timestamp(self._query("pi", (pin_,)))
         try:
             return float(rd)
         except:
@@ -252,15 +984,10 @@ class Arduino(object):
             pin_ = -pin
         else:
             pin_ = pin
-        cmd_str = build_cmd_str("ps", (pin_,))
+        self.invalidate_shadow(pin)
         durations = []
         for s in range(numTrials):
-            try:
-                self.sr.write(cmd_str)
-                self.sr.flush()
-            except:
-                pass
-            rd = self.sr.readline().replace("\r\n", "")
+            rd = self._strip_timestamp(self._query("ps", (pin_,)))
             if rd.isdigit():
                 if (int(rd) > 1):
                     durations.append(int(rd))
@@ -274,6 +1001,63 @@ class Arduino(object):
         except:
             return -1
 
+    def pulseIn_stats(self, pin, val, numTrials=5, gap=10, tolerance=25):
+        """
+        Same measurement as pulseIn_set, but all the trials are run
+        and summarized by the board, in a single command.
+
+        inputs:
+           pin: pin number for pulse measurement
+           val: "HIGH" or "LOW". Pulse is measured
+                when this state is detected
+           numTrials: number of trials (at most 16)
+           gap: delay between two trials, in ms
+           tolerance: samples further than this percentage from the
+                median are rejected as outliers (0 keeps all of them)
+        returns:
+           dict with the 'mean', 'median', 'min' and 'max' durations
+           of the accepted samples and their number ('valid'), or None
+           if the response was malformed
+        """
+        if not 1 <= numTrials <= 16:
+            raise ValueError('pulseIn_stats() supports 1 to 16 trials.')
+        if val == "LOW":
+            pin_ = -pin
+        else:
+            pin_ = pin
+        self.invalidate_shadow(pin)
+        timeout = numTrials * (gap / 1000. + self.timeouts["ps"])
+        return parse_pulse_stats(self._query(
+            "psn", (pin_, numTrials, gap, tolerance), timeout=timeout))
+
+    def pulseIn_multi(self, pins, val, numTrials=5, gap=10, tolerance=25):
+        """
+        Runs pulseIn_stats on several sensors (at most 6), fired one
+        after the other by the board, gap ms apart.
+
+        returns:
+           list with the pulseIn_stats result of each pin
+        """
+        if not 1 <= len(pins) <= 6:
+            raise ValueError('pulseIn_multi() supports 1 to 6 pins.')
+        if not 1 <= numTrials <= 16:
+            raise ValueError('pulseIn_multi() supports 1 to 16 trials.')
+        if val == "LOW":
+            pins_ = [-pin for pin in pins]
+        else:
+            pins_ = list(pins)
+        self.invalidate_shadow(*pins)
+        timeout = numTrials * (gap / 1000. + self.timeouts["ps"])
+        with self.lock:
+            results = [self._query("psm", [numTrials, gap, tolerance] + pins_,
+                                   timeout=timeout)]
+            for pin in pins[1:]:
+                rd = self._readline(timeout + gap / 1000.)
+                if rd is None:
+                    raise ArduinoTimeout('No answer from the board to psm.')
+                results.append(rd)
+        return [parse_pulse_stats(rd) for rd in results]
+
     def close(self):
         if self.sr.isOpen():
             self.sr.flush()
@@ -288,17 +1072,65 @@ class Arduino(object):
         returns:
            value: 0 for "LOW", 1 for "HIGH"
         """
-        cmd_str = build_cmd_str("dr", (pin,))
-        try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-        except:
-            pass
-        rd = self.sr.readline().replace("\r\n", "")
+        if self.read_cache:
+            return self.read_cache.get(
+                ('dr', pin), lambda: self._read_pin("dr", pin),
+                share=not self.lock.owned())
+        return self._read_pin("dr", pin)
+
+    def portWrite(self, port, value, mask=0xFF, pins=()):
+        """
+        Writes the bits of value selected by mask to the output register
+        of an AVR port (PORTx) in a single step, leaving the other bits
+        unchanged. Ports the board does not have are ignored by the
+        sketch: pin_port() tells the ports of the pins.
+        inputs:
+           port: port letter ('B') or number
+           value: 8 bit value
+           mask: bits of the port to change
+           pins: pins affected by the write, to update the shadow. All
+                 pins are invalidated if none are given.
+        """
+        self.invalidate_shadow(*pins)
+        self._send("pw", (port_index(port), value & 0xFF, mask & 0xFF))
+
+    def portMode(self, port, value, mask=0xFF, pins=()):
+        """
+        Writes the mode register of an AVR port (DDRx): bits set in value
+        make the pins outputs, cleared bits inputs. Only the bits selected
+        by mask change.
+        """
+        self.invalidate_shadow(*pins)
+        self._send("pd", (port_index(port), value & 0xFF, mask & 0xFF))
+
+    def portRead(self, port):
+        """
+        Returns the 8 bit input register (PINx) of an AVR port. Raises
+        ValueError if the board has no such port.
+        """
+        rd = self._strip_timestamp(self._query("pr", (port_index(port),)))
         try:
-            return int(rd)
+            value = int(rd)
         except:
             return 0
+        if value < 0:
+            raise ValueError('The board has no port {0!r}.'.format(port))
+        return value
+
+    def pin_port(self, pin):
+        """
+        Returns the (port number, bit mask) of a digital pin, as reported
+        by the board. Raises ValueError if the pin is not on a port.
+        """
+        if pin not in self._port_map:
+            try:
+                port, mask = map(int, self._query("pmap", (pin,)).split())
+            except ValueError:
+                port = 0
+            if not port:
+                raise ValueError('Pin {0} is not on a port.'.format(pin))
+            self._port_map[pin] = (port, mask)
+        return self._port_map[pin]
 
     def Melody(self, pin, melody, durations):
         """
@@ -316,6 +1148,13 @@ class Arduino(object):
                                                 [4,8,8,4,4,4,4,4])
         Playing short melodies (1 or 2 tones) didn't cause
         trouble during testing
+
+        The melody is sent a few notes at a time, as each part starts
+        playing, so that other commands only wait for the part being
+        played. The calling thread is blocked until the last part was
+        sent, i.e. for all of the melody but its last few notes.
+        Returns -1 if the lists differ in length or a duration is not a
+        positive number.
         """
         NOTES = dict(
             B0=31, C1=33, CS1=35, D1=37, DS1=39, E1=41, F1=44, FS1=46, G1=49,
@@ -332,24 +1171,27 @@ class Arduino(object):
             AS7=3729, B7=3951, C8=4186, CS8=4435, D8=4699, DS8=4978)
         if (isinstance(melody, list)) and (isinstance(durations, list)):
             length = len(melody)
-            cmd_args = [length, pin]
-            if length == len(durations):
-                cmd_args.extend([NOTES.get(melody[note])
-                                for note in range(length)])
-                cmd_args.extend([durations[duration]
-                                for duration in range(len(durations))])
-                cmd_str = build_cmd_str("to", cmd_args)
-                try:
-                    self.sr.write(cmd_str)
-                    self.sr.flush()
-                except:
-                    pass
-                cmd_str = build_cmd_str("nto", [pin])
-                try:
-                    self.sr.write(cmd_str)
-                    self.sr.flush()
-                except:
-                    pass
+            valid = all(isinstance(d, numbers.Real) and d > 0
+                        for d in durations)
+            if length == len(durations) and valid:
+                self.invalidate_shadow(pin)
+                ends = []
+                for i in range(0, length, self.MELODY_CHUNK):
+                    notes = melody[i:i + self.MELODY_CHUNK]
+                    chunk_durations = durations[i:i + self.MELODY_CHUNK]
+                    cmd_args = [len(notes), pin]
+                    cmd_args.extend([NOTES.get(note) for note in notes])
+                    cmd_args.extend(chunk_durations)
+                    if len(ends) >= 2:
+                        # Keeps at most one part waiting on the board.
+                        time.sleep(max(ends[-2] - _now(), 0))
+                    self._send("to", cmd_args)
+                    # The board plays the notes before reading any other
+                    # command.
+                    self._busy_until = (max(self._busy_until, _now()) +
+                                        sum(1.3 / d for d in chunk_durations))
+                    ends.append(self._busy_until)
+                self._send("nto", [pin])
             else:
                 return -1
         else:
@@ -368,9 +1210,8 @@ class Arduino(object):
         will short circuit the pin, potentially damaging
         the Arduino/Shrimp and any hardware attached to the pin.
         '''
-        cmd_str = build_cmd_str("cap", (pin,))
-        self.sr.write(cmd_str)
-        rd = self.sr.readline().replace("\r\n", "")
+        self.invalidate_shadow(pin)
+        rd = self._query("cap", (pin,))
         if rd.isdigit():
             return int(rd)
 
@@ -384,10 +1225,8 @@ class Arduino(object):
             pinOrder (String): either 'MSBFIRST' or 'LSBFIRST'
             value (int): an integer from 0 and 255
         """
-        cmd_str = build_cmd_str("so",
-                               (dataPin, clockPin, pinOrder, value))
-        self.sr.write(cmd_str)
-        self.sr.flush()
+        self.invalidate_shadow(dataPin, clockPin)
+        self._send("so", (dataPin, clockPin, pinOrder, value))
 
     def shiftIn(self, dataPin, clockPin, pinOrder):
         """
@@ -400,10 +1239,8 @@ class Arduino(object):
         Output:
             (int) an integer from 0 to 255
         """
-        cmd_str = build_cmd_str("si", (dataPin, clockPin, pinOrder))
-        self.sr.write(cmd_str)
-        self.sr.flush()
-        rd = self.sr.readline().replace("\r\n", "")
+        self.invalidate_shadow(dataPin, clockPin)
+        rd = self._query("si", (dataPin, clockPin, pinOrder))
         if rd.isdigit():
             return int(rd)
 
@@ -438,56 +1275,37 @@ class Servos(object):
         self.servo_pos = {}
 
     def attach(self, pin, min=544, max=2400):
-        cmd_str = build_cmd_str("sva", (pin, min, max))
-
-        while True:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-
-            rd = self.sr.readline().replace("\r\n", "")
-            if rd:
-                break
-            else:
-                log.debug("trying to attach servo to pin {0}".format(pin))
+        self.board.invalidate_shadow(pin)
+        rd = self.board._query("sva", (pin, min, max))
         position = int(rd)
         self.servo_pos[pin] = position
         return 1
 
     def detach(self, pin):
         position = self.servo_pos[pin]
-        cmd_str = build_cmd_str("svd", (position,))
-        try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-        except:
-            pass
+        self.board.invalidate_shadow(pin)
+        self.board._send("svd", (position,))
         del self.servo_pos[pin]
 
     def write(self, pin, angle):
         position = self.servo_pos[pin]
-        cmd_str = build_cmd_str("svw", (position, angle))
-
-        self.sr.write(cmd_str)
-        self.sr.flush()
+        shadow = self.board.shadow
+        if shadow and not shadow.update(('servo', pin), ('svw', angle)):
+            return
+        self.board._send("svw", (position, angle))
 
     def writeMicroseconds(self, pin, uS):
         position = self.servo_pos[pin]
-        cmd_str = build_cmd_str("svwm", (position, uS))
-
-        self.sr.write(cmd_str)
-        self.sr.flush()
+        shadow = self.board.shadow
+        if shadow and not shadow.update(('servo', pin), ('svwm', uS)):
+            return
+        self.board._send("svwm", (position, uS))
 
     def read(self, pin):
         if pin not in self.servo_pos.keys():
             self.attach(pin)
         position = self.servo_pos[pin]
-        cmd_str = build_cmd_str("svr", (position,))
-        try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-        except:
-            pass
-        rd = self.sr.readline().replace("\r\n", "")
+        rd = self.board._query("svr", (position,))
         try:
             angle = int(rd)
             return angle
@@ -511,13 +1329,7 @@ class SoftwareSerial(object):
         Create software serial instance on
         specified tx,rx pins, at specified baud
         """
-        cmd_str = build_cmd_str("ss", (p1, p2, baud))
-        try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-        except:
-            pass
-        response = self.sr.readline().replace("\r\n", "")
+        response = self.board._query("ss", (p1, p2, baud))
         if response == "ss OK":
             self.connected = True
             return True
@@ -531,13 +1343,7 @@ class SoftwareSerial(object):
         using Arduino's 'write' function
         """
         if self.connected:
-            cmd_str = build_cmd_str("sw", (data,))
-            try:
-                self.sr.write(cmd_str)
-                self.sr.flush()
-            except:
-                pass
-            response = self.sr.readline().replace("\r\n", "")
+            response = self.board._query("sw", (data,))
             if response == "ss OK":
                 return True
         else:
@@ -549,10 +1355,7 @@ class SoftwareSerial(object):
         existing software serial instance
         """
         if self.connected:
-            cmd_str = build_cmd_str("sr")
-            self.sr.write(cmd_str)
-            self.sr.flush()
-            response = self.sr.readline().replace("\r\n", "")
+            response = self.board._query("sr")
             if response:
                 return response
         else:
@@ -564,6 +1367,9 @@ class EEPROM(object):
     Class for reading and writing to EEPROM. 
     """
 
+    # Bytes per dump command, hex encoded on the response line.
+    DUMP_CHUNK = 32
+
     def __init__(self, board):
         self.board = board
         self.sr = board.sr
@@ -572,14 +1378,10 @@ class EEPROM(object):
         """
         Returns size of EEPROM memory.
         """
-        cmd_str = build_cmd_str("sz")
-   
+        response = self.board._query("sz")
         try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-            response = self.sr.readline().replace("\r\n", "")
             return int(response)
-        except:
+        except ValueError:
             return 0
         
     def write(self, address, value=0):
@@ -593,25 +1395,542 @@ class EEPROM(object):
             value = 255
         elif value < 0:
             value = 0
-        cmd_str = build_cmd_str("eewr", (address, value))
-        try:
-            self.sr.write(cmd_str)
-            self.sr.flush()
-        except:
-            pass
+        self.board._send("eewr", (address, value))
     
     def read(self, adrress):
         """ Reads a byte from the EEPROM.
         
         :address: the location to write to, starting from 0 (int)
         """
-        cmd_str = build_cmd_str("eer", (adrress,))
+        response = self.board._query("eer", (adrress,))
         try:
-            self.sr.write(cmd_str)
-            self.sr.flush()            
-            response = self.sr.readline().replace("\r\n", "")
-            if response:
-                return int(response)
-        except:
+            return int(response)
+        except ValueError:
             return 0
+
+    def dump(self, address=0, length=None):
+        """ Reads a block of the EEPROM, as a bulk transfer.
+
+        The block is read DUMP_CHUNK bytes per command, so that more
+        urgent commands from other threads are sent in between.
+
+        :address: the first location to read (int)
+        :length: number of bytes to read, up to the end of the EEPROM by
+            default (int)
+        :returns: the bytes read (bytearray)
+        """
+        if length is None:
+            length = self.size() - address
+        data = bytearray()
+        while len(data) < length:
+            count = min(self.DUMP_CHUNK, length - len(data))
+            # Hex digits and line end: the transmission time of the
+            # response is added to its timeout.
+            response = self.board._query("eed", (address + len(data), count),
+                                         reply_bytes=2 * count + 2)
+            try:
+                chunk = bytearray(binascii.unhexlify(response))
+            except (TypeError, ValueError):
+                raise IOError('Malformed EEPROM dump {0!r}.'.format(response))
+            if len(chunk) != count:
+                raise IOError('Malformed EEPROM dump {0!r}.'.format(response))
+            data.extend(chunk)
+        return data
                                 
+
+
+class Macros(object):
+
+    """
+    Class for short programs of basic commands, stored on the board and
+    run with the board's timing, without any serial traffic per step.
+
+    A program is a list of steps, each one a tuple:
+
+        ('pinMode', pin, "INPUT" or "OUTPUT")
+        ('digitalWrite', pin, "HIGH" or "LOW")
+        ('analogWrite', pin, value)
+        ('servoWrite', pin, angle)  the servo must be attached
+        ('delay', ms)
+        ('delayMicroseconds', uS)
+        ('loop', step, times)  runs the steps from index step up to
+                               this one times times in total
+
+    Delays and loop counts are limited to 32767: longer delays can be
+    split into several steps.
+
+    pm, dw, aw and svw can be used as short step names.
+    """
+
+    MAX_MACROS = 4
+    MAX_STEPS = 8
+    # Keeps each upload command within the 64 byte buffer of the sketch.
+    STEPS_PER_CMD = 3
+    OPCODES = dict(
+        digitalWrite=1, dw=1, analogWrite=2, aw=2, pinMode=3, pm=3,
+        servoWrite=4, svw=4, delay=5, delayMicroseconds=6, loop=7)
+
+    def __init__(self, board):
+        self.board = board
+        self.sr = board.sr
+        self.durations = {}
+        self.pins = {}
+        self.running = None
+
+    def _encode(self, index, step, costs, pins):
+        """
+        Returns the (opcode, a, b) arguments of a step, and appends its
+        duration in seconds to costs.
+        """
+        try:
+            op = self.OPCODES[step[0]]
+        except KeyError:
+            raise ValueError('Unknown macro step {0!r}.'.format(step[0]))
+        cost = 0.0
+        if op == 1:
+            pins.add(step[1])
+            args = (step[1], 0 if step[2] == "LOW" else 1)
+        elif op == 2:
+            pins.add(step[1])
+            args = (step[1], min(max(step[2], 0), 255))
+        elif op == 3:
+            pins.add(step[1])
+            args = (step[1], 0 if step[2] == "INPUT" else 1)
+        elif op == 4:
+            pins.add(step[1])
+            if step[1] not in self.board.Servos.servo_pos:
+                raise ValueError('No servo attached to pin {0}.'.format(
+                    step[1]))
+            args = (self.board.Servos.servo_pos[step[1]], step[2])
+        elif op == 5:
+            args = (step[1], 0)
+            cost = step[1] / 1000.
+        elif op == 6:
+            args = (step[1], 0)
+            cost = step[1] / 1e6
+        else:
+            start, times = step[1], step[2]
+            if not 0 <= start < index or times < 1:
+                raise ValueError('Bad macro loop {0!r}.'.format(step))
+            args = (times - 1, start)
+            cost = (times - 1) * sum(costs[start:index])
+        # The board stores the arguments as 16 bit ints, and delays
+        # would wait for ~50 days if negative.
+        low = 0 if op >= 5 else -0x8000
+        if not all(low <= arg <= 0x7fff for arg in args):
+            raise ValueError('Macro step {0!r} is out of range.'.format(
+                step))
+        costs.append(cost)
+        return (op,) + args
+
+    def upload(self, id, steps):
+        """
+        Stores a program on the board under id (0 to 3), replacing the
+        previous one. Returns True if the board received all the steps.
+        """
+        if not 0 <= id < self.MAX_MACROS:
+            raise ValueError('Macro id must be from 0 to {0}.'.format(
+                self.MAX_MACROS - 1))
+        if len(steps) > self.MAX_STEPS:
+            raise ValueError('Macros are limited to {0} steps.'.format(
+                self.MAX_STEPS))
+        costs = []
+        pins = set()
+        encoded = [self._encode(i, step, costs, pins)
+                   for i, step in enumerate(steps)]
+        self.durations[id] = sum(costs)
+        self.pins[id] = pins
+        with self.board.lock:
+            self.board._send("mcc", (id,))
+            for i in range(0, len(encoded), self.STEPS_PER_CMD):
+                args = [id]
+                for step in encoded[i:i + self.STEPS_PER_CMD]:
+                    args.extend(step)
+                self.board._send("mca", args)
+            response = self.board._query("mcn", (id,))
+        return response == str(len(steps))
+
+    def run(self, id, repeat=1, wait=True):
+        """
+        Runs the program stored under id repeat times. If wait is True,
+        returns True once the board reports its completion. Otherwise
+        returns immediately, and the calling thread must call wait()
+        later: the board is reserved to that thread until then, other
+        threads waiting for their turn.
+        """
+        # Held until wait() reads the completion report, so that no other
+        # thread can take it for its own response.
+        self.board.lock.acquire(self.board.scheduler.priority("mcr"))
+        try:
+            # Only the thread holding the board can have a pending macro.
+            if self.running is not None:
+                self.wait()
+            self.board._send("mcr", (id, repeat))
+        except:
+            self.board.lock.release()
+            raise
+        self.running = id
+        self.board._busy_until = (
+            _now() + self.durations.get(id, 0) * repeat)
+        if wait:
+            return self.wait()
+
+    def wait(self):
+        """
+        Waits for the completion of the program started by run(), from
+        the thread that started it. Returns True if the board reported
+        it.
+        """
+        if self.running is None:
+            return False
+        if not self.board.lock.owned():
+            raise RuntimeError('Macro {0} was run by another thread.'.format(
+                self.running))
+        id = self.running
+        self.running = None
+        try:
+            if self.pins.get(id):
+                self.board.invalidate_shadow(*self.pins[id])
+            response = self.board._readline(self.board.rtt.timeout)
+        finally:
+            self.board.lock.release()
+        if response is None:
+            raise ArduinoTimeout('Macro {0} did not complete.'.format(id))
+        return response == "mc OK"
+
+
+class Waveform(object):
+
+    """
+    Class for PWM waveforms played by the board at a fixed sample rate.
+
+    The board plays from a double buffer of two 64 sample halves: longer
+    waveforms are streamed, each half being refilled while the other one
+    plays. Streaming needs about 3 bytes of link bandwidth per sample,
+    i.e. rate_hz up to ~300 at 9600 baud.
+    """
+
+    HALF = 64
+    MAX_PINS = 4
+    # Samples per load command, hex encoded to fit the 64 byte buffer.
+    CHUNK = 24
+
+    def __init__(self, board):
+        self.board = board
+        self.sr = board.sr
+        self.underruns = 0
+
+    def _load(self, half, samples):
+        for i in range(0, len(samples), self.CHUNK):
+            chunk = binascii.hexlify(bytes(samples[i:i + self.CHUNK]))
+            self.board._send(
+                "wvl", (half * self.HALF + i, chunk.decode('ascii')))
+        self.board._send("wvf", (half, len(samples)))
+
+    def status(self):
+        """
+        Returns a (playing, samples in half 0, samples in half 1) tuple,
+        or None if the response was malformed.
+        """
+        try:
+            playing, count0, count1 = map(
+                int, self.board._query("wvs").split())
+        except ValueError:
+            return None
+        return bool(playing), count0, count1
+
+    def stop(self):
+        """
+        Stops the playback and empties the buffer.
+        """
+        self.board._send("wvx")
+
+    def play(self, samples, rate_hz, pins, loop=False, wait=True):
+        """
+        Plays PWM values (0 to 255) on one or more pins.
+        inputs:
+           samples: values, as a list, a bytearray or a NumPy uint8 array
+           rate_hz: sample rate
+           pins: PWM pin number, or list of up to 4 pin numbers
+           loop: repeat the waveform until stop() is called. Looped
+                 waveforms are limited to 128 samples.
+           wait: wait for the end of the playback. Waveforms longer than
+                 128 samples are always waited for, since they are
+                 streamed.
+        returns:
+           True, or False if the board sent a malformed status
+        """
+        data = pwm_samples(samples)
+        if isinstance(pins, int):
+            pins = [pins]
+        if not data:
+            raise ValueError('The waveform is empty.')
+        if loop and len(data) > 2 * self.HALF:
+            raise ValueError('Looped waveforms are limited to {0} '
+                             'samples.'.format(2 * self.HALF))
+        if not 1 <= len(pins) <= self.MAX_PINS:
+            raise ValueError('Waveforms can be played on 1 to {0} '
+                             'pins.'.format(self.MAX_PINS))
+        halves = [data[i:i + self.HALF]
+                  for i in range(0, len(data), self.HALF)]
+        play_args = [int(round(1e6 / rate_hz)), 1 if loop else 0] + pins
+        self.stop()
+        for half, half_samples in enumerate(halves[:2]):
+            self._load(half, half_samples)
+        self.board._send("wvp", play_args)
+        self.board.invalidate_shadow(*pins)
+        if loop:
+            return True
+        poll = self.HALF / float(rate_hz) / 4
+        half = 0
+        for half_samples in halves[2:]:
+            while True:
+                status = self.status()
+                if status is None:
+                    return False
+                if not status[1 + half]:
+                    break
+                time.sleep(poll)
+            self._load(half, half_samples)
+            if not status[0]:
+                # The board ran out of samples before the refill.
+                self.underruns += 1
+                log.warning('Waveform underrun, restarting playback.')
+                self.board._send("wvp", play_args)
+            half = 1 - half
+        while wait:
+            status = self.status()
+            if status is None:
+                return False
+            if not status[0]:
+                break
+            time.sleep(poll)
+        return True
+
+
+class Bindings(object):
+
+    """
+    Class for rules run by the board on every loop(), that drive an
+    output from an input without any serial traffic.
+
+    Each update reads the input, optionally feeds it to a PID controller,
+    and maps the result to the output:
+
+        PWM / servo outputs: linear map from in_range to out_range,
+            clamped to out_range. The output is only rewritten when it
+            moves by more than deadband.
+        digital outputs: HIGH once the value reaches the on level of
+            thresholds, LOW once it reaches the off level, unchanged in
+            between (hysteresis). An on level below the off level
+            turns the output on for low values.
+
+    Inputs are ('analog', pin) or ('digital', pin), outputs ('pwm', pin),
+    ('servo', pin) (the servo must be attached) or ('digital', pin). Pins
+    driven by a binding should not be written by the host meanwhile.
+    """
+
+    MAX_BINDINGS = 4
+    INPUTS = dict(analog=0, digital=1)
+    OUTPUTS = dict(pwm=0, servo=1, digital=2)
+    OUT_RANGES = dict(pwm=(0, 255), servo=(0, 180))
+    # Characters of a command the sketch buffer holds, '!' excluded.
+    MAX_CMD_LENGTH = 63
+
+    def __init__(self, board):
+        self.board = board
+        self.sr = board.sr
+        self.pins = {}
+
+    def _check(self, cmd, args):
+        """
+        Raises ValueError if a command would overflow the command buffer
+        of the sketch, which would silently drop it.
+        """
+        if len(build_cmd_str(cmd, args)) - 1 > self.MAX_CMD_LENGTH:
+            raise ValueError('Binding parameters {0!r} are too long.'.format(
+                args))
+        return args
+
+    def install(self, id, input, output, in_range=(0, 1023),
+                out_range=None, deadband=0, thresholds=None, pid=None,
+                period_ms=0):
+        """
+        Installs and enables a binding under id (0 to 3), replacing the
+        previous one.
+        inputs:
+           input: ('analog' or 'digital', pin)
+           output: ('pwm', 'servo' or 'digital', pin)
+           in_range: (min, max) input, or PID output, range
+           out_range: (min, max) output range, by default 0-255 for PWM
+                      and 0-180 for servos. min > max inverts the map.
+           deadband: smallest output change written, for PWM / servos
+           thresholds: (on, off) levels of digital outputs, by default
+                       the middle of in_range
+           pid: (setpoint, kp, ki, kd) to regulate the input to setpoint,
+                the controller output being mapped from in_range
+           period_ms: time between updates, 0 to update on every loop
+        returns:
+           True if the board accepted the binding
+        """
+        if not 0 <= id < self.MAX_BINDINGS:
+            raise ValueError('Binding id must be from 0 to {0}.'.format(
+                self.MAX_BINDINGS - 1))
+        in_kind, in_pin = input
+        out_kind, out_pin = output
+        if in_kind not in self.INPUTS:
+            raise ValueError('Unknown binding input {0!r}.'.format(in_kind))
+        if out_kind not in self.OUTPUTS:
+            raise ValueError('Unknown binding output {0!r}.'.format(
+                out_kind))
+        out = out_pin
+        if out_kind == 'servo':
+            try:
+                out = self.board.Servos.servo_pos[out_pin]
+            except KeyError:
+                raise ValueError('No servo attached to pin {0}.'.format(
+                    out_pin))
+        commands = [("bdi", (id, self.INPUTS[in_kind], in_pin,
+                             self.OUTPUTS[out_kind], out, period_ms))]
+        if out_kind == 'digital':
+            if thresholds is None:
+                middle = (in_range[0] + in_range[1]) // 2
+                thresholds = (middle, middle)
+            commands.append(("bdh", (id,) + tuple(thresholds)))
+        out_range = out_range or self.OUT_RANGES.get(out_kind, (0, 1))
+        commands.append(("bdt", (id,) + tuple(in_range) + tuple(out_range) +
+                         (deadband,)))
+        if pid is not None:
+            setpoint, kp, ki, kd = pid
+            # Limited precision keeps the command within the buffer.
+            commands.append(("bdp", (id, int(setpoint)) + tuple(
+                '{0:.6g}'.format(gain) for gain in (kp, ki, kd))))
+        for cmd, args in commands:
+            self._check(cmd, args)
+        with self.board.lock:
+            for cmd, args in commands:
+                self.board._send(cmd, args)
+            self.board.invalidate_shadow(out_pin)
+            self.pins[id] = out_pin
+            return self.enable(id)
+
+    def enable(self, id, enable=True):
+        """
+        Resumes or pauses a binding. Returns True if the binding exists.
+        """
+        response = self.board._query("bde", (id, 1 if enable else 0))
+        if id in self.pins:
+            self.board.invalidate_shadow(self.pins[id])
+        return response == "bd OK"
+
+    def remove(self, id):
+        """
+        Removes a binding. Its output keeps its last value.
+        """
+        self.board._send("bdr", (id,))
+        pin = self.pins.pop(id, None)
+        if pin is not None:
+            self.board.invalidate_shadow(pin)
+
+    def clear(self):
+        """
+        Removes all the bindings.
+        """
+        self.board._send("bdr", (-1,))
+        if self.pins:
+            self.board.invalidate_shadow(*self.pins.values())
+        self.pins.clear()
+
+    def list(self):
+        """
+        Returns the bindings set on the board, as a list of dicts with
+        their id, enabled flag, input and output tuples, and the last
+        input and output values (-1 before the first update). Returns
+        None if the response was malformed.
+        """
+        inputs = dict((v, k) for k, v in self.INPUTS.items())
+        outputs = dict((v, k) for k, v in self.OUTPUTS.items())
+        bindings = []
+        with self.board.lock:
+            try:
+                n = int(self.board._query("bdl"))
+            except ValueError:
+                return None
+            for i in range(n):
+                rd = self.board._readline(self.board.rtt.timeout)
+                if rd is None:
+                    raise ArduinoTimeout('No answer from the board to bdl.')
+                try:
+                    (id, enabled, in_kind, in_pin, out_kind, out_pin,
+                     last_in, last_out) = map(int, rd.split())
+                    bindings.append(dict(
+                        id=id, enabled=bool(enabled),
+                        input=(inputs[in_kind], in_pin),
+                        output=(outputs[out_kind], out_pin),
+                        last_input=last_in, last_output=last_out))
+                except (KeyError, ValueError):
+                    return None
+        return bindings
+
+
+class PinGroup(object):
+
+    """
+    Group of digital pins driven as a parallel bus: bit i of the bus
+    value is pins[i].
+
+    Writes take one command per AVR port used by the group, and all the
+    pins of a port change at the same time. Groups wired to a single port
+    are therefore updated without intermediate states.
+    """
+
+    def __init__(self, board, pins):
+        self.board = board
+        self.pins = list(pins)
+        self._ports = None
+
+    def _layout(self):
+        # {port: [(bus bit, port bit mask)]}, queried from the board once.
+        if self._ports is None:
+            ports = {}
+            for bit, pin in enumerate(self.pins):
+                port, mask = self.board.pin_port(pin)
+                ports.setdefault(port, []).append((1 << bit, mask))
+            self._ports = ports
+        return self._ports
+
+    def _port_values(self, value):
+        for port, bits in sorted(self._layout().items()):
+            port_value = port_mask = 0
+            for bus_bit, mask in bits:
+                port_mask |= mask
+                if value & bus_bit:
+                    port_value |= mask
+            yield port, port_value, port_mask
+
+    def write(self, value):
+        """
+        Sets the pins to the bits of value.
+        """
+        for port, port_value, port_mask in self._port_values(value):
+            self.board.portWrite(port, port_value, port_mask, self.pins)
+
+    def mode(self, val):
+        """
+        Sets the mode of all the pins, "INPUT" or "OUTPUT".
+        """
+        value = 0 if val == "INPUT" else -1
+        for port, port_value, port_mask in self._port_values(value):
+            self.board.portMode(port, port_value, port_mask, self.pins)
+
+    def read(self):
+        """
+        Returns the bus value read from the pins.
+        """
+        value = 0
+        for port, bits in sorted(self._layout().items()):
+            port_value = self.board.portRead(port)
+            for bus_bit, mask in bits:
+                if port_value & mask:
+                    value |= bus_bit
+        return value
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Background logging of pin readings to a binary file.
+
+A log file starts with a 64 byte header:
+
+    magic (8 bytes) | version (uint16) | number of pins (uint16) |
+    rows per chunk (uint32) | wall clock start time (float64) |
+    monotonic start time (float64) | pins (one int8 each) | zero padding
+
+followed by fixed size rows, each made of the host monotonic time of
+the reading (float64) and one uint16 reading per pin. All values are
+little endian, so that a log can be memory mapped as a NumPy structured
+array (see read_log).
+
+Rows are written a chunk at a time. After each chunk, an entry
+(file offset, rows, time of first row, time of last row, wall clock
+time, monotonic time) is appended to an index file next to the log,
+named after it with an .idx suffix. The last two are read together when
+the chunk is written, to convert the row times to wall clock times even
+if the system clock was adjusted since the start (see wall_times).
+"""
+import logging
+import os
+import struct
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'ARDLOG01'
+VERSION = 2
+HEADER_SIZE = 64
+HEADER = struct.Struct('<8sHHIdd')
+MAX_PINS = HEADER_SIZE - HEADER.size
+INDEX = struct.Struct('<QIdddd')
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+def _row_struct(n_pins):
+    return struct.Struct('<d{0}H'.format(n_pins))
+
+
+def _read_header(f, path):
+    header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise ValueError('{0} is not a data log.'.format(path))
+    magic, version, n_pins, chunk_rows, start, start_t = \
+        HEADER.unpack_from(header)
+    if magic != MAGIC or n_pins > MAX_PINS:
+        raise ValueError('{0} is not a data log.'.format(path))
+    if version != VERSION:
+        raise ValueError('{0} is a version {1} data log, not {2}.'.format(
+            path, version, VERSION))
+    pins = list(struct.unpack_from('<{0}b'.format(n_pins), header,
+                                   HEADER.size))
+    return dict(version=version, pins=pins, chunk_rows=chunk_rows,
+                start=start, start_t=start_t)
+
+
+def log_dtype(n_pins):
+    """
+    Returns the NumPy dtype of the rows of a log of n_pins pins, with a
+    't' field for the time and a 'values' field for the readings.
+    """
+    import numpy as np
+    return np.dtype([('t', '<f8'), ('values', '<u2', (n_pins,))])
+
+
+def read_log(path):
+    """
+    Maps a log file written by DataLogger.
+
+    Input:
+        path (str): log file
+    Output:
+        (dict) with the 'pins', 'chunk_rows', 'start' (wall clock time)
+        and 'start_t' (monotonic time) of the log, and its complete
+        'rows' as a read-only numpy.memmap of log_dtype(len(pins)). Rows
+        are read from disk as they are accessed.
+    """
+    import numpy as np
+    with open(path, 'rb') as f:
+        info = _read_header(f, path)
+    dtype = log_dtype(len(info['pins']))
+    n_rows = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if n_rows:
+        info['rows'] = np.memmap(path, dtype=dtype, mode='r',
+                                 offset=HEADER_SIZE, shape=(n_rows,))
+    else:
+        info['rows'] = np.empty(0, dtype=dtype)
+    return info
+
+
+def read_index(path):
+    """
+    Returns the (offset, rows, t_first, t_last, wall, t) entries of the
+    index of a log file, one per chunk written.
+    """
+    entries = []
+    with open(path + '.idx', 'rb') as f:
+        while True:
+            entry = f.read(INDEX.size)
+            if len(entry) < INDEX.size:
+                break
+            entries.append(INDEX.unpack(entry))
+    return entries
+
+
+def wall_times(path):
+    """
+    Returns the wall clock times of the rows of a log file, as a NumPy
+    float64 array. The rows of each chunk are converted with the clock
+    times read when the chunk was written, the others with the ones read
+    at the start of the log.
+    """
+    info = read_log(path)
+    t = info['rows']['t']
+    times = t + (info['start'] - info['start_t'])
+    if os.path.exists(path + '.idx'):
+        row_size = log_dtype(len(info['pins'])).itemsize
+        for offset, rows, _, _, wall, mono in read_index(path):
+            first = (offset - HEADER_SIZE) // row_size
+            times[first:first + rows] = t[first:first + rows] + (wall - mono)
+    return times
+
+
+class DataLogger(object):
+
+    """
+    Reads pins in a background thread and appends the readings to a log
+    file, a chunk at a time.
+
+    The board can still be used from other threads while logging: each
+    reading holds the board lock for a single exchange.
+    """
+
+    def __init__(self, board, path, pins, interval=0.0, chunk_rows=1024,
+                 read=None, max_rows=None):
+        """
+        Input:
+            board (Arduino): board to read from
+            path (str): log file. Rows are appended to it if it exists.
+            pins (list): pins to read
+            interval (float): target time between rows, in seconds. 0
+                reads as fast as the board answers.
+            chunk_rows (int): rows buffered before each write to disk
+            read (callable): reads one pin, default board.analogRead
+            max_rows (int): stops after this many rows, default never
+        """
+        pins = list(pins)
+        if not 0 < len(pins) <= MAX_PINS:
+            raise ValueError('Between 1 and {0} pins can be logged.'.format(
+                MAX_PINS))
+        self.board = board
+        self.path = path
+        self.pins = pins
+        self.interval = interval
+        self.chunk_rows = chunk_rows
+        self.read = read or board.analogRead
+        self.max_rows = max_rows
+        self.rows = 0
+        self.errors = 0
+        self.error = None
+        self._row = _row_struct(len(pins))
+        self._chunk = bytearray(self._row.size * chunk_rows)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Opens the log file and starts logging.
+        """
+        if self.running:
+            return
+        self._open()
+        self.rows = 0
+        self.error = None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops logging, once the current reading completes, and writes the
+        rows not yet on disk.
+        """
+        self._stop.set()
+        return self.wait()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the logger to stop, for at most timeout seconds.
+        Returns True if it has stopped. Raises the error that stopped it,
+        if any.
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def _open(self):
+        new = not os.path.exists(self.path) or \
+            os.path.getsize(self.path) == 0
+        if not new:
+            with open(self.path, 'rb') as f:
+                info = _read_header(f, self.path)
+            if info['pins'] != self.pins:
+                raise ValueError('{0} logs pins {1}, not {2}.'.format(
+                    self.path, info['pins'], self.pins))
+        self._file = open(self.path, 'ab')
+        self._index = open(self.path + '.idx', 'ab')
+        if new:
+            header = bytearray(HEADER_SIZE)
+            HEADER.pack_into(header, 0, MAGIC, VERSION, len(self.pins),
+                             self.chunk_rows, time.time(), _now())
+            struct.pack_into('<{0}b'.format(len(self.pins)), header,
+                             HEADER.size, *self.pins)
+            self._file.write(header)
+            self._file.flush()
+        else:
+            # Drops a row left incomplete by a crash, to keep rows aligned.
+            size = os.path.getsize(self.path)
+            extra = (size - HEADER_SIZE) % self._row.size
+            if extra:
+                self._file.truncate(size - extra)
+                self._file.seek(0, os.SEEK_END)
+
+    def _sample(self):
+        values = []
+        for pin in self.pins:
+            value = self.read(pin)
+            values.append(min(max(int(value), 0), 0xffff))
+        return values
+
+    def _run(self):
+        n = 0
+        t_first = None
+        next_row = _now()
+        try:
+            while not self._stop.is_set():
+                if self.max_rows is not None and self.rows >= self.max_rows:
+                    break
+                try:
+                    values = self._sample()
+                except IOError as e:
+                    # Including ArduinoTimeout: the row is skipped.
+                    log.debug('Logger read failed: {0}'.format(e))
+                    self.errors += 1
+                    values = None
+                if values is not None:
+                    t = _now()
+                    self._row.pack_into(self._chunk, n * self._row.size,
+                                        t, *values)
+                    if not n:
+                        t_first = t
+                    n += 1
+                    self.rows += 1
+                    if n == self.chunk_rows:
+                        self._write(n, t_first, t)
+                        n = 0
+                if self.interval:
+                    next_row += self.interval
+                    delay = next_row - _now()
+                    if delay > 0:
+                        self._stop.wait(delay)
+                    else:
+                        # Too slow to keep up: do not try to catch up.
+                        next_row = _now()
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                if n:
+                    t_last = self._row.unpack_from(
+                        self._chunk, (n - 1) * self._row.size)[0]
+                    self._write(n, t_first, t_last)
+            finally:
+                self._file.close()
+                self._index.close()
+
+    def _write(self, n, t_first, t_last):
+        offset = self._file.tell()
+        self._file.write(memoryview(self._chunk)[:n * self._row.size])
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._index.write(INDEX.pack(offset, n, t_first, t_last,
+                                     time.time(), _now()))
+        self._index.flush()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+Capture and replay of the serial traffic exchanged with a board.
+
+A capture file is an append-only sequence of records, each made of a
+fixed 11 byte header followed by its payload:
+
+    kind (1 byte) | timestamp in microseconds (uint64) | length (uint16)
+
+All integers are little endian. The kind is one of:
+
+    'S' start of a recording session, payload is the wall clock time
+        (float64) at which the session started. Timestamps of the
+        following records are relative to this record.
+    'W' / 'w' data written to the board, as text / as bytes
+    'R' / 'r' data read from the board, as text / as bytes
+
+Several sessions can be appended to the same file.
+"""
+import logging
+import os
+import struct
+import time
+
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'ARDCAP01'
+RECORD = struct.Struct('<cQH')
+SESSION = struct.Struct('<d')
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+def _to_bytes(data):
+    if isinstance(data, bytes):
+        return data, False
+    return data.encode('latin-1'), True
+
+
+def _from_bytes(data, text):
+    if text and not isinstance(data, str):
+        return data.decode('latin-1')
+    return data
+
+
+def read_capture(path):
+    """
+    Iterates over the records of a capture file.
+
+    Input:
+        path (str): capture file written by RecordingSerial
+    Output:
+        yields (session, kind, t, data) tuples, where session is the
+        index of the recording session, kind is 'W' for writes and 'R'
+        for reads, t the time in seconds since the start of the session
+        and data the transferred data, as it was passed to or returned
+        by the serial object.
+    """
+    session = -1
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a capture file.'.format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            kind, t, length = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                # Truncated by a crash while recording.
+                break
+            kind = kind.decode('ascii')
+            if kind == 'S':
+                session += 1
+                continue
+            yield (session, kind.upper(), t / 1e6,
+                   _from_bytes(payload, kind.isupper()))
+
+
+class RecordingSerial(object):
+
+    """
+    Wraps a serial object and logs every write and read to a capture
+    file, with monotonic timestamps. All other attributes are forwarded
+    to the wrapped object.
+    """
+
+    def __init__(self, sr, path):
+        self.sr = sr
+        self.path = path
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab')
+        if new:
+            self._file.write(MAGIC)
+        self._start = _now()
+        self._record('S', SESSION.pack(time.time()))
+
+    def __getattr__(self, name):
+        return getattr(self.sr, name)
+
+    @property
+    def timeout(self):
+        return self.sr.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.sr.timeout = value
+
+    def _record(self, kind, payload):
+        if self._file.closed:
+            return
+        t = int((_now() - self._start) * 1e6)
+        self._file.write(RECORD.pack(kind.encode('ascii'), t, len(payload)))
+        self._file.write(payload)
+
+    def write(self, data):
+        payload, text = _to_bytes(data)
+        # Long writes are split so that each record fits its length field.
+        for i in range(0, max(len(payload), 1), 0xffff):
+            self._record('W' if text else 'w', payload[i:i + 0xffff])
+        return self.sr.write(data)
+
+    def readline(self):
+        data = self.sr.readline()
+        payload, text = _to_bytes(data)
+        self._record('R' if text else 'r', payload)
+        return data
+
+    def read(self, size=1):
+        data = self.sr.read(size)
+        payload, text = _to_bytes(data)
+        self._record('R' if text else 'r', payload)
+        return data
+
+    def flush(self):
+        self.sr.flush()
+        if not self._file.closed:
+            self._file.flush()
+
+    def close(self):
+        try:
+            self.sr.close()
+        finally:
+            if not self._file.closed:
+                self._file.close()
+
+
+class ReplaySerial(object):
+
+    """
+    Serial stand-in that feeds a capture file back to an Arduino object.
+
+    Reads are answered with the recorded responses. With a speed of 1.0
+    each response is delayed by the time it originally took the board to
+    answer the preceding write; larger values replay faster, and a speed
+    of None answers immediately.
+
+    If strict is True, a write that differs from the recorded one raises
+    a ValueError.
+
+    in_waiting is not defined: the size of the input is unknown until a
+    read, so that a timed out read is drained by discarding the input
+    rather than by waiting for the link to be idle.
+    """
+
+    def __init__(self, path, speed=1.0, session=-1, strict=False):
+        sessions = {}
+        for s, kind, t, data in read_capture(path):
+            sessions.setdefault(s, []).append((kind, t, data))
+        if not sessions:
+            raise ValueError('{0} contains no recording.'.format(path))
+        self.records = sessions[sorted(sessions)[session]]
+        self.speed = speed
+        self.strict = strict
+        self.timeout = None
+        self.is_open = True
+        self._pos = 0
+        self._anchor = (_now(), 0.0)
+        # Rest of a recorded read not yet returned by read(size).
+        self._pending = b''
+
+    def isOpen(self):
+        return self.is_open
+
+    def close(self):
+        self.is_open = False
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        self._pending = b''
+
+    reset_input_buffer = flushInput
+
+    def write(self, data):
+        while (self._pos < len(self.records) and
+               self.records[self._pos][0] != 'W'):
+            self._pos += 1
+        if self._pos == len(self.records):
+            log.debug('Write past the end of the recording.')
+            return len(data)
+        kind, t, expected = self.records[self._pos]
+        self._pos += 1
+        if self.strict and expected != data:
+            raise ValueError('Expected write {0!r}, got {1!r}.'.format(
+                expected, data))
+        self._anchor = (_now(), t)
+        return len(data)
+
+    def readline(self):
+        if self._pending:
+            data, self._pending = self._pending, b''
+            return data
+        if (self._pos == len(self.records) or
+                self.records[self._pos][0] != 'R'):
+            # Nothing was read at this point of the recording: behave as
+            # a timed out read.
+            return ''
+        kind, t, data = self.records[self._pos]
+        self._pos += 1
+        if self.speed:
+            host, recorded = self._anchor
+            delay = host + (t - recorded) / self.speed - _now()
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def read(self, size=1):
+        data = self.readline()
+        if data == '':
+            return b''
+        data, self._pending = data[:size], data[size:]
+        return data
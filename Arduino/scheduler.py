@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+Scheduling of the commands sent to a board by several threads.
+
+Each command belongs to a priority class: CONTROL (outputs driven by
+control loops), SENSING (readings) or BULK (transfers such as melodies,
+EEPROM dumps or waveform uploads). When several threads wait for the
+link, the one with the most urgent class is served first, and bulk
+transfers are split into commands short enough for control commands to
+be sent in between.
+
+Each class can also be rate limited, so that background traffic leaves
+link bandwidth to the control loop.
+"""
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+
+
+CONTROL, SENSING, BULK = 0, 1, 2
+
+# Priority class of each command, SENSING for the ones not listed.
+COMMAND_CLASSES = dict(
+    dw=CONTROL, aw=CONTROL, pm=CONTROL, pw=CONTROL, pd=CONTROL,
+    svw=CONTROL, svwm=CONTROL, nto=CONTROL, wvx=CONTROL, mcr=CONTROL,
+    bde=CONTROL, bdr=CONTROL,
+    to=BULK, eewr=BULK, eed=BULK, wvl=BULK, wvf=BULK, mcc=BULK, mca=BULK,
+    acq=BULK, st=BULK)
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class PriorityLock(object):
+
+    """
+    Reentrant lock granted to the waiting thread with the lowest priority
+    value, then in arrival order.
+
+    Using the lock itself as a context manager acquires it with SENSING
+    priority; lock(priority) returns a context manager for another one.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._count = 0
+        self._waiting = []
+        self._seq = itertools.count()
+
+    def owned(self):
+        """
+        Returns True if the calling thread holds the lock.
+        """
+        return self._owner is threading.current_thread()
+
+    def acquire(self, priority=SENSING):
+        me = threading.current_thread()
+        with self._cond:
+            if self._owner is me:
+                self._count += 1
+                return True
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            while self._owner is not None or self._waiting[0] != entry:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._owner = me
+            self._count = 1
+        return True
+
+    def release(self):
+        with self._cond:
+            if self._owner is not threading.current_thread():
+                raise RuntimeError('Cannot release an un-acquired lock.')
+            self._count -= 1
+            if not self._count:
+                self._owner = None
+                self._cond.notify_all()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @contextlib.contextmanager
+    def __call__(self, priority):
+        self.acquire(priority)
+        try:
+            yield self
+        finally:
+            self.release()
+
+
+class TokenBucket(object):
+
+    """
+    Allows rate events per second on average, in bursts of up to burst
+    events.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._last = _now()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Takes a token if one is available. Otherwise returns the time to
+        wait, in seconds, before trying again.
+        """
+        with self._lock:
+            now = _now()
+            self._tokens = min(self._tokens + (now - self._last) * self.rate,
+                               self.burst)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def wait(self):
+        """
+        Waits for a token and takes it.
+        """
+        while True:
+            delay = self.take()
+            if not delay:
+                return
+            time.sleep(delay)
+
+
+class Scheduler(object):
+
+    """
+    Orders the access of threads to a board by priority class, and
+    enforces the per class rate limits.
+    """
+
+    def __init__(self, rate_limits=None):
+        """
+        rate_limits maps priority classes to a maximum number of commands
+        per second, or to a (rate, burst) tuple.
+        """
+        self.lock = PriorityLock()
+        self.classes = dict(COMMAND_CLASSES)
+        self.buckets = {}
+        for cls, limit in (rate_limits or {}).items():
+            if isinstance(limit, tuple):
+                self.set_rate(cls, *limit)
+            else:
+                self.set_rate(cls, limit)
+
+    def set_rate(self, cls, rate, burst=1):
+        """
+        Limits the commands of a class to rate per second, or removes the
+        limit if rate is None.
+        """
+        if rate is None:
+            self.buckets.pop(cls, None)
+        else:
+            self.buckets[cls] = TokenBucket(rate, burst)
+
+    def priority(self, cmd):
+        """
+        Returns the priority class of a command.
+        """
+        return self.classes.get(cmd, SENSING)
+
+    @contextlib.contextmanager
+    def transaction(self, cls):
+        """
+        Holds the link for an exchange of priority class cls, once its
+        rate limit allows it. Nested transactions of a thread that
+        already holds the link are neither delayed nor limited.
+        """
+        if not self.lock.owned():
+            bucket = self.buckets.get(cls)
+            if bucket:
+                bucket.wait()
+        with self.lock(cls):
+            yield
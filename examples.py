@@ -47,6 +47,18 @@ def adjustBrightness(pot_pin, led_pin, baud, port=""):
         board.analogWrite(led_pin, val)
 
 
+def bindBrightness(pot_pin, led_pin, baud, port=""):
+    """
+    Same as adjustBrightness, with the potentiometer
+    bound to the LED on the board itself.
+    """
+    board = Arduino(baud, port=port)
+    board.Bindings.install(0, ("analog", pot_pin), ("pwm", led_pin))
+    while True:
+        time.sleep(1)
+        print board.Bindings.list()[0]["last_output"]
+
+
 def PingSonar(pw_pin, baud, port=""):
     """
     Gets distance measurement from Ping)))
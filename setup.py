@@ -3,6 +3,7 @@ from setuptools import setup
 setup(name='arduino-python',
       version='0.2',
       install_requires=['pyserial'],
+      extras_require={'numpy': ['numpy']},
       description="A light-weight Python library that provides a serial \
       bridge for communicating with Arduino microcontroller boards.",
       author='Tristan Hearn',
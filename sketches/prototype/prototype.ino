@@ -7,6 +7,7 @@ SoftwareSerial *sserial = NULL;
 Servo servos[8];
 int servo_pins[] = {0, 0, 0, 0, 0, 0, 0, 0};
 boolean connected = false;
+boolean stamp_readings = false;
 
 int Str2int (String Str_value)
 {
@@ -26,7 +27,26 @@ void split(String results[], int len, String input, char spChar) {
 }
 
 void Version(){
-  Serial.println("version");
+  Serial.println(F("version"));
+}
+
+void printReading(long value, unsigned long t){
+  // Readings are followed by the micros() time of the sample when
+  // timestamps are enabled.
+  Serial.print(value);
+  if (stamp_readings) {
+    Serial.print(' ');
+    Serial.print(t);
+  }
+  Serial.println();
+}
+
+void TimestampHandler(String data){
+  stamp_readings = Str2int(data) != 0;
+}
+
+void ClockHandler(){
+  Serial.println(micros());
 }
 
 uint8_t readCapacitivePin(String data) {
@@ -122,7 +142,8 @@ void ToneNo(String data){
 void DigitalHandler(int mode, String data){
       int pin = Str2int(data);
     if(mode<=0){ //read
-        Serial.println(digitalRead(pin));
+        unsigned long t = micros();
+        printReading(digitalRead(pin), t);
     }else{
         if(pin <0){
             digitalWrite(-pin,LOW);
@@ -136,7 +157,8 @@ void DigitalHandler(int mode, String data){
 void AnalogHandler(int mode, String data){
      if(mode<=0){ //read
         int pin = Str2int(data);
-        Serial.println(analogRead(pin));
+        unsigned long t = micros();
+        printReading(analogRead(pin), t);
     }else{
         String sdata[2];
         split(sdata,2,data,'%');
@@ -146,6 +168,39 @@ void AnalogHandler(int mode, String data){
     }
 }
 
+#define MAX_ACQ_PINS 6
+
+void AcquireHandler(String data){
+    // period_us%n_samples%pin1%pin2... Samples the analog pins every
+    // period_us, sending each reading as 2 bytes (little endian), then
+    // prints the number of samples that were taken late.
+    String sdata[2 + MAX_ACQ_PINS];
+    int len = 1;
+    for (unsigned int i = 0; i < data.length(); i++) {
+        if (data.charAt(i) == '%') len++;
+    }
+    len = min(len, 2 + MAX_ACQ_PINS);
+    split(sdata, len, data, '%');
+    unsigned long period = sdata[0].toInt();
+    long n = sdata[1].toInt();
+    int npins = len - 2;
+    int pins[MAX_ACQ_PINS];
+    for (int j = 0; j < npins; j++) pins[j] = Str2int(sdata[j + 2]);
+    long late = 0;
+    unsigned long next = micros();
+    for (long i = 0; i < n; i++) {
+        while ((long)(micros() - next) < 0) {;}
+        if (micros() - next > period) late++;
+        next += period;
+        for (int j = 0; j < npins; j++) {
+            int v = analogRead(pins[j]);
+            Serial.write(v & 0xff);
+            Serial.write(v >> 8);
+        }
+    }
+    Serial.println(late);
+}
+
 void ConfigurePinHandler(String data){
     int pin = Str2int(data);
     if(pin <=0){
@@ -155,6 +210,53 @@ void ConfigurePinHandler(String data){
     }
 }
 
+volatile uint8_t* portRegister(int port, int reg) {
+    // reg 0: output (PORTx), 1: mode (DDRx), 2: input (PINx). Ports are
+    // numbered as by digitalPinToPort: A is 1, B is 2... Only the ports
+    // of some pin of this board are accepted: the register tables of the
+    // core have no entry for the others.
+    boolean found = false;
+    for (int pin = 0; pin < NUM_DIGITAL_PINS && !found; pin++) {
+        found = port != NOT_A_PORT && digitalPinToPort(pin) == port;
+    }
+    if (!found) return NULL;
+    if (reg == 0) return portOutputRegister(port);
+    if (reg == 1) return portModeRegister(port);
+    return portInputRegister(port);
+}
+
+void PortWriteHandler(int reg, String data){
+    // port%value%mask. Only the bits set in mask change, all at once.
+    String sdata[3];
+    split(sdata, 3, data, '%');
+    volatile uint8_t* r = portRegister(Str2int(sdata[0]), reg);
+    if (r == NULL) return;
+    byte value = Str2int(sdata[1]);
+    byte mask = Str2int(sdata[2]);
+    uint8_t oldSREG = SREG;
+    cli(); // no interrupt handler may touch the port in between
+    *r = (*r & ~mask) | (value & mask);
+    SREG = oldSREG;
+}
+
+void PortReadHandler(String data){
+    volatile uint8_t* r = portRegister(Str2int(data), 2);
+    unsigned long t = micros();
+    printReading(r == NULL ? -1 : *r, t);
+}
+
+void PortMapHandler(String data){
+    // Prints the port and bit mask of a pin, or 0 0 if it has none.
+    int pin = Str2int(data);
+    if (pin < 0 || pin >= NUM_DIGITAL_PINS) {
+        Serial.println(F("0 0"));
+        return;
+    }
+    Serial.print(digitalPinToPort(pin));
+    Serial.print(' ');
+    Serial.println(digitalPinToBitMask(pin));
+}
+
 void shiftOutHandler(String data) {    
     String sdata[4];
     split(sdata, 4, data, '%');
@@ -193,14 +295,14 @@ void SS_set(String data){
   int baud_ = Str2int(sdata[2]);
   sserial = new SoftwareSerial(rx_, tx_);
   sserial->begin(baud_);
-  Serial.println("ss OK");
+  Serial.println(F("ss OK"));
 }
 
 void SS_write(String data) {
  int len = data.length()+1;
  char buffer[len];
  data.toCharArray(buffer,len);
- Serial.println("ss OK");
+ Serial.println(F("ss OK"));
  sserial->write(buffer); 
 }
 void SS_read(String data) {
@@ -218,11 +320,10 @@ void pulseInHandler(String data){
           pinMode(pin, INPUT);
           duration = pulseIn(pin, HIGH);      
     }
-    Serial.println(duration);
+    printReading(duration, micros());
 }
 
-void pulseInSHandler(String data){
-    int pin = Str2int(data);
+long pulseInS(int pin){
     long duration;
     if(pin <=0){
           pinMode(-pin, OUTPUT);
@@ -243,7 +344,92 @@ void pulseInSHandler(String data){
           pinMode(pin, INPUT);
           duration = pulseIn(pin, HIGH);      
     }
-    Serial.println(duration);
+    return duration;
+}
+
+void pulseInSHandler(String data){
+    int pin = Str2int(data);
+    long duration = pulseInS(pin);
+    printReading(duration, micros());
+}
+
+#define MAX_PULSE_TRIALS 16
+#define MAX_PULSE_SENSORS 6
+
+void pulseInStats(int pin, int trials, int gap, int tolerance){
+    // Runs pulseInS() several times and prints the mean, median, min, max
+    // and number of the samples that are neither timeouts nor outliers
+    // (further than tolerance % from the median).
+    long samples[MAX_PULSE_TRIALS];
+    int n = 0;
+    trials = constrain(trials, 1, MAX_PULSE_TRIALS);
+    for (int i = 0; i < trials; i++) {
+        if (i > 0) delay(gap);
+        long duration = pulseInS(pin);
+        if (duration > 1) samples[n++] = duration;
+    }
+    // insertion sort, n is small
+    for (int i = 1; i < n; i++) {
+        long v = samples[i];
+        int j = i - 1;
+        while (j >= 0 && samples[j] > v) {
+            samples[j + 1] = samples[j];
+            j--;
+        }
+        samples[j + 1] = v;
+    }
+    long median = 0;
+    if (n > 0) median = samples[n / 2];
+    int valid = 0;
+    long sum = 0, lo = 0, hi = 0;
+    for (int i = 0; i < n; i++) {
+        long v = samples[i];
+        if (tolerance > 0 && abs(v - median) * 100 > (long)tolerance * median) continue;
+        if (valid == 0) lo = v;
+        hi = v;
+        samples[valid++] = v;
+        sum += v;
+    }
+    float mean = 0, med = 0;
+    if (valid > 0) {
+        mean = (float)sum / valid;
+        if (valid % 2) med = samples[valid / 2];
+        else med = (samples[valid / 2 - 1] + samples[valid / 2]) / 2.0;
+    }
+    Serial.print(mean, 2);
+    Serial.print(' ');
+    Serial.print(med, 1);
+    Serial.print(' ');
+    Serial.print(lo);
+    Serial.print(' ');
+    Serial.print(hi);
+    Serial.print(' ');
+    Serial.println(valid);
+}
+
+void pulseInStatsHandler(String data){
+    String sdata[4];
+    split(sdata, 4, data, '%');
+    pulseInStats(Str2int(sdata[0]), Str2int(sdata[1]),
+                 Str2int(sdata[2]), Str2int(sdata[3]));
+}
+
+void pulseInStatsMultiHandler(String data){
+    // trials%gap%tolerance%pin1%pin2... one response line per pin
+    String sdata[3 + MAX_PULSE_SENSORS];
+    int len = 1;
+    for (unsigned int i = 0; i < data.length(); i++) {
+        if (data.charAt(i) == '%') len++;
+    }
+    len = min(len, 3 + MAX_PULSE_SENSORS);
+    split(sdata, len, data, '%');
+    int trials = Str2int(sdata[0]);
+    int gap = Str2int(sdata[1]);
+    int tolerance = Str2int(sdata[2]);
+    for (int i = 3; i < len; i++) {
+        if (i > 3) delay(gap);
+        pulseInStats(Str2int(sdata[i]), trials, gap, tolerance);
+    }
 }
 
 void SV_add(String data) {
@@ -255,10 +441,10 @@ void SV_add(String data) {
     int pos = -1;
     for (int i = 0; i<8;i++) {
         if (servo_pins[i] == pin) { //reset in place
-            servos[pos].detach();
-            servos[pos].attach(pin, min, max);
-            servo_pins[pos] = pin;
-            Serial.println(pos);
+            servos[i].detach();
+            servos[i].attach(pin, min, max);
+            servo_pins[i] = pin;
+            Serial.println(i);
             return;
             }
         }
@@ -302,6 +488,107 @@ void SV_write_ms(String data) {
     servos[pos].writeMicroseconds(uS);
 }
 
+#define MAX_MACROS 4
+#define MAX_MACRO_STEPS 8
+#define MC_DW 1
+#define MC_AW 2
+#define MC_PM 3
+#define MC_SVW 4
+#define MC_DELAY 5
+#define MC_DELAY_US 6
+#define MC_LOOP 7
+
+struct MacroStep {
+  byte op;
+  int a;
+  int b;
+};
+
+MacroStep macros[MAX_MACROS][MAX_MACRO_STEPS];
+byte macro_len[MAX_MACROS];
+
+void MC_clear(String data) {
+    int id = Str2int(data);
+    if (id >= 0 && id < MAX_MACROS) macro_len[id] = 0;
+}
+
+void MC_append(String data) {
+    // id%op%a%b[%op%a%b...], at most 3 steps per command
+    String sdata[10];
+    int len = 1;
+    for (unsigned int i = 0; i < data.length(); i++) {
+        if (data.charAt(i) == '%') len++;
+    }
+    len = min(len, 10);
+    split(sdata, len, data, '%');
+    int id = Str2int(sdata[0]);
+    if (id < 0 || id >= MAX_MACROS) return;
+    for (int i = 1; i + 2 < len; i += 3) {
+        if (macro_len[id] == MAX_MACRO_STEPS) return;
+        MacroStep &step = macros[id][macro_len[id]++];
+        step.op = Str2int(sdata[i]);
+        step.a = Str2int(sdata[i + 1]);
+        step.b = Str2int(sdata[i + 2]);
+    }
+}
+
+void MC_length(String data) {
+    int id = Str2int(data);
+    if (id < 0 || id >= MAX_MACROS) Serial.println(-1);
+    else Serial.println(macro_len[id]);
+}
+
+void MC_run(String data) {
+    String sdata[2];
+    split(sdata, 2, data, '%');
+    int id = Str2int(sdata[0]);
+    int repeat = Str2int(sdata[1]);
+    if (id < 0 || id >= MAX_MACROS) {
+        Serial.println(F("mc ERR"));
+        return;
+    }
+    // remaining jumps of each loop step, -1 when the loop is not running
+    int counters[MAX_MACRO_STEPS];
+    for (int r = 0; r < repeat; r++) {
+        for (int i = 0; i < MAX_MACRO_STEPS; i++) counters[i] = -1;
+        int i = 0;
+        while (i < macro_len[id]) {
+            MacroStep &step = macros[id][i];
+            switch (step.op) {
+                case MC_DW:
+                    digitalWrite(step.a, step.b ? HIGH : LOW);
+                    break;
+                case MC_AW:
+                    analogWrite(step.a, step.b);
+                    break;
+                case MC_PM:
+                    pinMode(step.a, step.b ? OUTPUT : INPUT);
+                    break;
+                case MC_SVW:
+                    servos[step.a].write(step.b);
+                    break;
+                case MC_DELAY:
+                    delay(step.a);
+                    break;
+                case MC_DELAY_US:
+                    delayMicroseconds(step.a);
+                    break;
+                case MC_LOOP:
+                    if (counters[i] < 0) counters[i] = step.a;
+                    if (counters[i] > 0) {
+                        counters[i]--;
+                        i = step.b;
+                        continue;
+                    }
+                    counters[i] = -1;
+                    break;
+            }
+            i++;
+        }
+    }
+    Serial.println(F("mc OK"));
+}
+
 void sizeEEPROM() {
     Serial.println(E2END + 1);
 }
@@ -316,16 +603,467 @@ void EEPROMHandler(int mode, String data) {
     }
 }
 
+#define MAX_DUMP 32
+
+void EEPROMDumpHandler(String data) {
+    // address%count: prints up to MAX_DUMP bytes as hex on one line.
+    String sdata[2];
+    split(sdata, 2, data, '%');
+    int address = Str2int(sdata[0]);
+    int count = min(Str2int(sdata[1]), MAX_DUMP);
+    for (int i = 0; i < count && address + i <= E2END; i++) {
+        byte b = EEPROM.read(address + i);
+        if (b < 16) Serial.print('0');
+        Serial.print(b, HEX);
+    }
+    Serial.println();
+}
+
+#define WAVE_HALF 64
+#define MAX_WAVE_PINS 4
+
+// Double buffer: one half is played while the host refills the other.
+byte wave_buffer[2 * WAVE_HALF];
+byte wave_count[2] = {0, 0}; // samples in each half, 0 when free
+byte wave_pins[MAX_WAVE_PINS];
+byte wave_npins = 0;
+boolean wave_playing = false;
+boolean wave_loop = false;
+byte wave_half = 0;
+byte wave_index = 0;
+unsigned long wave_period = 0;
+unsigned long wave_next = 0;
+
+byte hexDigit(char c) {
+    if (c >= 'a') return c - 'a' + 10;
+    if (c >= 'A') return c - 'A' + 10;
+    return c - '0';
+}
+
+void WV_load(String data) {
+    // offset%hex encoded samples
+    int idx = data.indexOf('%');
+    int offset = Str2int(data.substring(0, idx));
+    for (unsigned int i = idx + 1; i + 1 < data.length(); i += 2) {
+        if (offset < 0 || offset >= 2 * WAVE_HALF) return;
+        wave_buffer[offset++] = (hexDigit(data.charAt(i)) << 4) |
+                                hexDigit(data.charAt(i + 1));
+    }
+}
+
+void WV_fill(String data) {
+    // half%count: marks a half as holding count samples
+    String sdata[2];
+    split(sdata, 2, data, '%');
+    int half = Str2int(sdata[0]);
+    if (half < 0 || half > 1) return;
+    wave_count[half] = constrain(Str2int(sdata[1]), 0, WAVE_HALF);
+}
+
+void WV_play(String data) {
+    // period_us%loop%pin1%pin2...
+    String sdata[2 + MAX_WAVE_PINS];
+    int len = 1;
+    for (unsigned int i = 0; i < data.length(); i++) {
+        if (data.charAt(i) == '%') len++;
+    }
+    len = min(len, 2 + MAX_WAVE_PINS);
+    split(sdata, len, data, '%');
+    wave_period = sdata[0].toInt();
+    wave_loop = Str2int(sdata[1]) != 0;
+    wave_npins = len - 2;
+    for (int j = 0; j < wave_npins; j++) wave_pins[j] = Str2int(sdata[j + 2]);
+    wave_half = wave_count[0] ? 0 : 1;
+    wave_index = 0;
+    wave_next = micros();
+    wave_playing = wave_count[wave_half] > 0;
+}
+
+void WV_stop() {
+    wave_playing = false;
+    wave_count[0] = 0;
+    wave_count[1] = 0;
+}
+
+void WV_status() {
+    Serial.print(wave_playing);
+    Serial.print(' ');
+    Serial.print(wave_count[0]);
+    Serial.print(' ');
+    Serial.println(wave_count[1]);
+}
+
+void WaveformService() {
+    if (!wave_playing) return;
+    unsigned long now = micros();
+    if ((long)(now - wave_next) < 0) return;
+    // Skip ahead rather than bursting after a blocking command.
+    if (now - wave_next > wave_period) wave_next = now;
+    wave_next += wave_period;
+    byte value = wave_buffer[wave_half * WAVE_HALF + wave_index];
+    for (int j = 0; j < wave_npins; j++) analogWrite(wave_pins[j], value);
+    if (++wave_index < wave_count[wave_half]) return;
+    wave_index = 0;
+    if (!wave_loop) wave_count[wave_half] = 0; // free for a refill
+    if (wave_count[1 - wave_half] > 0) wave_half = 1 - wave_half;
+    else if (!wave_loop || wave_count[wave_half] == 0) wave_playing = false;
+}
+
+#define MAX_BINDINGS 4
+#define BD_IN_ANALOG 0
+#define BD_IN_DIGITAL 1
+#define BD_OUT_PWM 0
+#define BD_OUT_SERVO 1
+#define BD_OUT_DIGITAL 2
+
+// Input to output rule, run by BindingService() on every loop().
+struct Binding {
+  boolean used;
+  boolean enabled;
+  byte in_kind;
+  byte in_pin;
+  byte out_kind;
+  byte out_pin; // servo index for servo outputs
+  unsigned int period; // ms between updates, 0 for every loop
+  unsigned long last_run; // micros()
+  // Linear map of the input (or of the PID output) to the output,
+  // clamped to the output range. The output is only rewritten when it
+  // moves by more than deadband.
+  int in_min;
+  int in_max;
+  int out_min;
+  int out_max;
+  int deadband;
+  // Digital outputs: HIGH from on_level up, LOW from off_level down, or
+  // the other way round if on_level < off_level.
+  int on_level;
+  int off_level;
+  boolean pid;
+  int setpoint;
+  float kp;
+  float ki;
+  float kd;
+  float integral;
+  int last_in;
+  int last_out;
+};
+
+Binding bindings[MAX_BINDINGS];
+
+Binding* bindingArg(String data) {
+  int id = Str2int(data);
+  if (id < 0 || id >= MAX_BINDINGS) return NULL;
+  return &bindings[id];
+}
+
+void BD_io(String data) {
+  // id%in_kind%in_pin%out_kind%out_pin%period_ms. The binding is reset,
+  // and stays disabled until bde.
+  String sdata[6];
+  split(sdata, 6, data, '%');
+  Binding* b = bindingArg(sdata[0]);
+  if (b == NULL) return;
+  b->used = true;
+  b->enabled = false;
+  b->in_kind = Str2int(sdata[1]);
+  b->in_pin = Str2int(sdata[2]);
+  b->out_kind = Str2int(sdata[3]);
+  b->out_pin = Str2int(sdata[4]);
+  b->period = Str2int(sdata[5]);
+  b->in_min = 0;
+  b->in_max = 1023;
+  b->out_min = 0;
+  b->out_max = 255;
+  b->deadband = 0;
+  b->on_level = 512;
+  b->off_level = 512;
+  b->pid = false;
+  b->last_out = -1;
+  if (b->out_kind == BD_OUT_DIGITAL) pinMode(b->out_pin, OUTPUT);
+}
+
+void BD_transfer(String data) {
+  // id%in_min%in_max%out_min%out_max%deadband
+  String sdata[6];
+  split(sdata, 6, data, '%');
+  Binding* b = bindingArg(sdata[0]);
+  if (b == NULL) return;
+  b->in_min = Str2int(sdata[1]);
+  b->in_max = Str2int(sdata[2]);
+  b->out_min = Str2int(sdata[3]);
+  b->out_max = Str2int(sdata[4]);
+  b->deadband = Str2int(sdata[5]);
+}
+
+void BD_hysteresis(String data) {
+  // id%on_level%off_level
+  String sdata[3];
+  split(sdata, 3, data, '%');
+  Binding* b = bindingArg(sdata[0]);
+  if (b == NULL) return;
+  b->on_level = Str2int(sdata[1]);
+  b->off_level = Str2int(sdata[2]);
+}
+
+void BD_pid(String data) {
+  // id%setpoint%kp%ki%kd
+  String sdata[5];
+  split(sdata, 5, data, '%');
+  Binding* b = bindingArg(sdata[0]);
+  if (b == NULL) return;
+  b->pid = true;
+  b->setpoint = Str2int(sdata[1]);
+  b->kp = sdata[2].toFloat();
+  b->ki = sdata[3].toFloat();
+  b->kd = sdata[4].toFloat();
+}
+
+void BD_enable(String data) {
+  // id%enable, answers "bd OK", or "bd ERR" for an unset binding.
+  String sdata[2];
+  split(sdata, 2, data, '%');
+  Binding* b = bindingArg(sdata[0]);
+  if (b == NULL || !b->used) {
+    Serial.println(F("bd ERR"));
+    return;
+  }
+  b->enabled = Str2int(sdata[1]) != 0;
+  b->integral = 0;
+  b->last_in = -1;
+  b->last_run = micros();
+  Serial.println(F("bd OK"));
+}
+
+void BD_remove(String data) {
+  // id, or -1 for all the bindings.
+  int id = Str2int(data);
+  for (int i = 0; i < MAX_BINDINGS; i++) {
+    if (id < 0 || id == i) {
+      bindings[i].used = false;
+      bindings[i].enabled = false;
+    }
+  }
+}
+
+void BD_list() {
+  // Prints the number of bindings set, then one "id enabled in_kind
+  // in_pin out_kind out_pin last_in last_out" line for each of them.
+  int n = 0;
+  for (int i = 0; i < MAX_BINDINGS; i++) if (bindings[i].used) n++;
+  Serial.println(n);
+  for (int i = 0; i < MAX_BINDINGS; i++) {
+    Binding &b = bindings[i];
+    if (!b.used) continue;
+    Serial.print(i); Serial.print(' ');
+    Serial.print(b.enabled); Serial.print(' ');
+    Serial.print(b.in_kind); Serial.print(' ');
+    Serial.print(b.in_pin); Serial.print(' ');
+    Serial.print(b.out_kind); Serial.print(' ');
+    if (b.out_kind == BD_OUT_SERVO) Serial.print(servo_pins[b.out_pin]);
+    else Serial.print(b.out_pin);
+    Serial.print(' ');
+    Serial.print(b.last_in); Serial.print(' ');
+    Serial.println(b.last_out);
+  }
+}
+
+void runBinding(Binding &b, unsigned long now) {
+  float dt = (now - b.last_run) / 1e6;
+  b.last_run = now;
+  int x;
+  if (b.in_kind == BD_IN_DIGITAL) x = digitalRead(b.in_pin);
+  else x = analogRead(b.in_pin);
+  float u = x;
+  if (b.pid) {
+    float error = b.setpoint - x;
+    float integral = b.integral + error * dt;
+    // Derivative on the measurement, so that setpoint changes do not
+    // kick the output.
+    float derivative = (b.last_in < 0 || dt <= 0) ? 0 :
+      (b.last_in - x) / dt;
+    u = b.kp * error + b.ki * integral + b.kd * derivative;
+    // Anti-windup: the integral only grows while the output is within
+    // its range.
+    if (u >= b.in_min && u <= b.in_max) b.integral = integral;
+  }
+  b.last_in = x;
+  int y;
+  if (b.out_kind == BD_OUT_DIGITAL) {
+    // Schmitt trigger: keeps the previous state between the levels.
+    boolean rising = b.on_level >= b.off_level;
+    if (rising ? u >= b.on_level : u <= b.on_level) y = HIGH;
+    else if (rising ? u <= b.off_level : u >= b.off_level) y = LOW;
+    else if (b.last_out < 0) return;
+    else y = b.last_out;
+    if (y != b.last_out) digitalWrite(b.out_pin, y);
+    b.last_out = y;
+    return;
+  }
+  float span = b.in_max - b.in_min;
+  if (span == 0) span = 1;
+  float scaled = b.out_min + (u - b.in_min) * (b.out_max - b.out_min) / span;
+  int lo = min(b.out_min, b.out_max);
+  int hi = max(b.out_min, b.out_max);
+  y = constrain((int) (scaled + 0.5), lo, hi);
+  if (b.last_out >= 0 && abs(y - b.last_out) <= b.deadband) return;
+  if (b.out_kind == BD_OUT_SERVO) servos[b.out_pin].write(y);
+  else analogWrite(b.out_pin, y);
+  b.last_out = y;
+}
+
+void BindingService() {
+  unsigned long now = micros();
+  for (int i = 0; i < MAX_BINDINGS; i++) {
+    Binding &b = bindings[i];
+    if (!b.enabled) continue;
+    if (now - b.last_run < (unsigned long) b.period * 1000) continue;
+    runBinding(b, now);
+  }
+}
+
+// Performance counters, reported by the st command.
+// Command names, in the order of the per command counters.
+const char cmd_names[] PROGMEM =
+  "dw dr aw ar acq pm pw pd pr pmap ps pi psn psm ss sw sr sva svr svw "
+  "svwm svd version tsm tm to nto cap so si eewr eer eed sz mcc mca mcn "
+  "mcr wvl wvf wvp wvx wvs st bdi bdt bdh bdp bde bdr bdl";
+#define N_CMDS 51
+#define CMD_TIMEOUT 1000 // ms before a partial command is dropped
+
+unsigned int op_count[N_CMDS];
+unsigned long op_time[N_CMDS]; // microseconds
+unsigned long loops = 0;
+unsigned long loop_max = 0; // microseconds
+unsigned long stats_start = 0; // millis() at the last reset
+unsigned int rx_overflows = 0;
+unsigned int parse_errors = 0;
+unsigned int rx_timeouts = 0;
+boolean stats_reset = false;
+
+int opcodeIndex(String cmd) {
+  // Returns the index of cmd in cmd_names, or -1 if it is unknown.
+  int index = 0;
+  int pos = 0; // characters matched in the current name, -1 on a mismatch
+  for (int i = 0; ; i++) {
+    char c = pgm_read_byte(cmd_names + i);
+    if (c == ' ' || c == 0) {
+      if (pos == (int) cmd.length()) return index;
+      if (c == 0) return -1;
+      index++;
+      pos = 0;
+    } else if (pos >= 0 && pos < (int) cmd.length() && cmd.charAt(pos) == c) {
+      pos++;
+    } else {
+      pos = -1;
+    }
+  }
+}
+
+void printOpcodeName(int index) {
+  int i = 0;
+  while (index > 0) {
+    if (pgm_read_byte(cmd_names + i++) == ' ') index--;
+  }
+  char c;
+  while ((c = pgm_read_byte(cmd_names + i++)) != ' ' && c != 0) {
+    Serial.print(c);
+  }
+}
+
+int freeMemory() {
+  extern int __heap_start, *__brkval;
+  int v;
+  return (int) &v - (__brkval == 0 ? (int) &__heap_start : (int) __brkval);
+}
+
+void resetStats() {
+  for (int i = 0; i < N_CMDS; i++) {
+    op_count[i] = 0;
+    op_time[i] = 0;
+  }
+  loops = 0;
+  loop_max = 0;
+  rx_overflows = 0;
+  parse_errors = 0;
+  rx_timeouts = 0;
+  stats_start = millis();
+}
+
+void StatsHandler(String data){
+  // Prints "loops elapsed_ms loop_max_us rx_overflows parse_errors
+  // rx_timeouts free_ram n", then one "name count time_us" line for
+  // each of the n commands run since the last reset.
+  int n = 0;
+  for (int i = 0; i < N_CMDS; i++) if (op_count[i]) n++;
+  Serial.print(loops); Serial.print(' ');
+  Serial.print(millis() - stats_start); Serial.print(' ');
+  Serial.print(loop_max); Serial.print(' ');
+  Serial.print(rx_overflows); Serial.print(' ');
+  Serial.print(parse_errors); Serial.print(' ');
+  Serial.print(rx_timeouts); Serial.print(' ');
+  Serial.print(freeMemory()); Serial.print(' ');
+  Serial.println(n);
+  for (int i = 0; i < N_CMDS; i++) {
+    if (!op_count[i]) continue;
+    printOpcodeName(i);
+    Serial.print(' ');
+    Serial.print(op_count[i]);
+    Serial.print(' ');
+    Serial.println(op_time[i]);
+  }
+  stats_reset = Str2int(data) != 0;
+}
+
+char cmd_buffer[64];
+byte cmd_length = 0;
+boolean cmd_overflow = false;
+unsigned long cmd_last_char = 0;
+
+boolean readCommand() {
+  // Collects characters up to the '!' terminator without blocking, so
+  // that loop() keeps servicing waveform playback between commands.
+  if (cmd_length > 0 && !Serial.available() &&
+      millis() - cmd_last_char > CMD_TIMEOUT) {
+    // The rest of the command was lost: drop it.
+    cmd_length = 0;
+    cmd_overflow = false;
+    rx_timeouts++;
+  }
+  while (Serial.available()) {
+    char c = Serial.read();
+    cmd_last_char = millis();
+    if (c == '!') {
+      boolean complete = !cmd_overflow;
+      if (cmd_overflow) rx_overflows++;
+      cmd_buffer[cmd_length] = 0;
+      cmd_length = 0;
+      cmd_overflow = false;
+      if (complete) return true;
+      continue;
+    }
+    if (cmd_length < sizeof(cmd_buffer) - 1) {
+      cmd_buffer[cmd_length++] = c;
+    } else {
+      cmd_overflow = true;
+    }
+  }
+  return false;
+}
+
 void SerialParser(void) {
-  char readChar[64];
-  Serial.readBytesUntil(33,readChar,64);
-  String read_ = String(readChar);
+  String read_ = String(cmd_buffer);
   //Serial.println(readChar);
   int idx1 = read_.indexOf('%');
   int idx2 = read_.indexOf('$');
   // separate command from associated data
   String cmd = read_.substring(1,idx1);
   String data = read_.substring(idx1+1,idx2);
+  int opcode = opcodeIndex(cmd);
+  if (read_.charAt(0) != '@' || idx2 < 0 || opcode < 0) {
+      parse_errors++;
+      return;
+  }
+  unsigned long t0 = micros();
   
   // determine command sent
   if (cmd == "dw") {
@@ -340,15 +1078,36 @@ void SerialParser(void) {
   else if (cmd == "ar") {
       AnalogHandler(0, data);   
   }      
+  else if (cmd == "acq") {
+      AcquireHandler(data);
+  }
   else if (cmd == "pm") {
       ConfigurePinHandler(data);   
   }    
+  else if (cmd == "pw") {
+      PortWriteHandler(0, data);
+  }
+  else if (cmd == "pd") {
+      PortWriteHandler(1, data);
+  }
+  else if (cmd == "pr") {
+      PortReadHandler(data);
+  }
+  else if (cmd == "pmap") {
+      PortMapHandler(data);
+  }
   else if (cmd == "ps") {
       pulseInSHandler(data);   
   }    
   else if (cmd == "pi") {
       pulseInHandler(data);   
   }        
+  else if (cmd == "psn") {
+      pulseInStatsHandler(data);
+  }
+  else if (cmd == "psm") {
+      pulseInStatsMultiHandler(data);
+  }
   else if (cmd == "ss") {
       SS_set(data);   
   }
@@ -376,6 +1135,12 @@ void SerialParser(void) {
   else if (cmd == "version") {
       Version();   
   }
+  else if (cmd == "tsm") {
+      TimestampHandler(data);
+  }
+  else if (cmd == "tm") {
+      ClockHandler();
+  }
   else if (cmd == "to") {
       Tone(data);   
   } 
@@ -397,9 +1162,69 @@ void SerialParser(void) {
   else if (cmd == "eer") {
       EEPROMHandler(1, data);   
   }  
+  else if (cmd == "eed") {
+      EEPROMDumpHandler(data);
+  }
   else if (cmd == "sz") {  
       sizeEEPROM();
   }  
+  else if (cmd == "mcc") {
+      MC_clear(data);
+  }
+  else if (cmd == "mca") {
+      MC_append(data);
+  }
+  else if (cmd == "mcn") {
+      MC_length(data);
+  }
+  else if (cmd == "mcr") {
+      MC_run(data);
+  }
+  else if (cmd == "wvl") {
+      WV_load(data);
+  }
+  else if (cmd == "wvf") {
+      WV_fill(data);
+  }
+  else if (cmd == "wvp") {
+      WV_play(data);
+  }
+  else if (cmd == "wvx") {
+      WV_stop();
+  }
+  else if (cmd == "wvs") {
+      WV_status();
+  }
+  else if (cmd == "st") {
+      StatsHandler(data);
+  }
+  else if (cmd == "bdi") {
+      BD_io(data);
+  }
+  else if (cmd == "bdt") {
+      BD_transfer(data);
+  }
+  else if (cmd == "bdh") {
+      BD_hysteresis(data);
+  }
+  else if (cmd == "bdp") {
+      BD_pid(data);
+  }
+  else if (cmd == "bde") {
+      BD_enable(data);
+  }
+  else if (cmd == "bdr") {
+      BD_remove(data);
+  }
+  else if (cmd == "bdl") {
+      BD_list();
+  }
+  op_count[opcode]++;
+  op_time[opcode] += micros() - t0;
+  if (stats_reset) {
+      stats_reset = false;
+      resetStats();
+  }
 }
 
 void setup()  {
@@ -410,5 +1235,13 @@ void setup()  {
 }
 
 void loop() {
-   SerialParser();
+   unsigned long t0 = micros();
+   if (readCommand()) {
+       SerialParser();
+   }
+   WaveformService();
+   BindingService();
+   unsigned long dt = micros() - t0;
+   if (dt > loop_max) loop_max = dt;
+   loops++;
    }
@@ -1,6 +1,15 @@
 import logging
+import os
+import shutil
+import struct
+import tempfile
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -13,6 +22,7 @@ class MockSerial(object):
         self.timeout = timeout
         self.output = []
         self.input = []
+        self.raw = b''
         self.is_open = True
 
     def flush(self):
@@ -36,13 +46,57 @@ class MockSerial(object):
         """
         return self.input.pop(0)
 
+    def read(self, size=1):
+        data, self.raw = self.raw[:size], self.raw[size:]
+        return data
+
     def reset_mock(self):
         self.output = []
         self.input = []
+        self.raw = b''
 
     def push_line(self, line, term='\r\n'):
         self.input.append(str(line) + term)
 
+    def push_bytes(self, data):
+        self.raw += data
+
+
+class StreamSerial(MockSerial):
+
+    """
+    Serial stand-in with a single input stream. Each write queues the
+    next scripted (reply, late) pair: reply can be read at once, late
+    only once the reader has polled in_waiting or written again.
+    """
+
+    def __init__(self, replies):
+        MockSerial.__init__(self, 9600, '/dev/ttyACM0')
+        self.replies = list(replies)
+        self.stream = ''
+        self.late = ''
+
+    def write(self, line):
+        MockSerial.write(self, line)
+        self.stream += self.late
+        reply, self.late = self.replies.pop(0) if self.replies else ('', '')
+        self.stream += reply
+
+    @property
+    def in_waiting(self):
+        self.stream += self.late
+        self.late = ''
+        return len(self.stream)
+
+    def readline(self):
+        end = self.stream.find('\n') + 1 or len(self.stream)
+        data, self.stream = self.stream[:end], self.stream[end:]
+        return data
+
+    def read(self, size=1):
+        data, self.stream = self.stream[:size], self.stream[size:]
+        return data.encode('latin-1')
+
 
 INPUT = "INPUT"
 OUTPUT = "OUTPUT"
@@ -119,6 +173,39 @@ class TestArduino(ArduinoTestCase):
         self.assertEquals(self.board.pulseIn(pin, HIGH), expected_duration)
         self.assertEquals(self.mock_serial.output[0], build_cmd_str('pi', (pin,)))
 
+    def test_pulseIn_stats(self):
+        from Arduino.arduino import build_cmd_str
+        pin = 9
+        self.mock_serial.push_line('230.50 231.0 220 240 4')
+        self.assertEquals(self.board.pulseIn_stats(pin, HIGH, numTrials=5),
+            dict(mean=230.5, median=231.0, min=220, max=240, valid=4))
+        self.assertEquals(self.mock_serial.output[0],
+            build_cmd_str('psn', (pin, 5, 10, 25)))
+
+    def test_pulseIn_stats_no_echo(self):
+        self.mock_serial.push_line('0.00 0.0 0 0 0')
+        self.assertEquals(self.board.pulseIn_stats(9, HIGH)['valid'], 0)
+        self.mock_serial.push_line('')
+        self.assertEquals(self.board.pulseIn_stats(9, HIGH), None)
+
+    def test_pulseIn_limits(self):
+        self.assertRaises(ValueError, self.board.pulseIn_stats, 7, HIGH,
+                          numTrials=20)
+        self.assertRaises(ValueError, self.board.pulseIn_multi,
+                          list(range(2, 9)), HIGH)
+        self.assertRaises(ValueError, self.board.pulseIn_multi, [2], HIGH,
+                          numTrials=17)
+        self.assertEquals(self.mock_serial.output, [])
+
+    def test_pulseIn_multi(self):
+        from Arduino.arduino import build_cmd_str
+        self.mock_serial.push_line('100.00 100.0 100 100 3')
+        self.mock_serial.push_line('200.00 200.0 200 200 3')
+        results = self.board.pulseIn_multi([7, 8], LOW, numTrials=3, gap=20)
+        self.assertEquals([r['mean'] for r in results], [100.0, 200.0])
+        self.assertEquals(self.mock_serial.output[0],
+            build_cmd_str('psm', (3, 20, 25, -7, -8)))
+
     def test_digitalRead(self):
         from Arduino.arduino import build_cmd_str
         pin = 9
@@ -190,6 +277,93 @@ class TestArduino(ArduinoTestCase):
             build_cmd_str('aw', (pin, value)))
 
 
+class TestTimeouts(ArduinoTestCase):
+
+    def test_retry(self):
+        from Arduino.arduino import build_cmd_str
+        self.mock_serial.push_line('', term='')
+        self.mock_serial.push_line(512)
+        self.assertEquals(self.board.analogRead(0), 512)
+        self.assertEquals(self.mock_serial.output,
+                          [build_cmd_str('ar', (0,))] * 2)
+
+    def test_partial_line(self):
+        self.mock_serial.push_line('51', term='')
+        self.mock_serial.push_line(512)
+        self.assertEquals(self.board.analogRead(0), 512)
+
+    def test_timeout(self):
+        from Arduino.arduino import ArduinoTimeout
+        for i in range(3):
+            self.mock_serial.push_line('', term='')
+        self.assertRaises(ArduinoTimeout, self.board.digitalRead, 0)
+        self.assertEquals(len(self.mock_serial.output), 3)
+
+    def test_no_retry(self):
+        from Arduino.arduino import ArduinoTimeout
+        self.mock_serial.push_line('', term='')
+        self.assertRaises(ArduinoTimeout, self.board.shiftIn, 2, 3, MSBFIRST)
+        self.assertEquals(len(self.mock_serial.output), 1)
+        self.assertEquals(self.mock_serial.timeout, 2)
+
+    def test_adaptive_timeout(self):
+        self.mock_serial.push_line(512)
+        self.board.analogRead(0)
+        expected = self.board.rtt.timeout
+        self.assertTrue(expected < 2)
+        self.mock_serial.push_line(512)
+        self.board.analogRead(0)
+        self.assertEquals(self.mock_serial.timeout, expected)
+
+    def test_override(self):
+        self.mock_serial.push_line(230)
+        self.board.pulseIn(9, HIGH)
+        self.assertEquals(self.mock_serial.timeout, 1.5)
+        self.board.timeouts['pi'] = 3
+        self.mock_serial.push_line(230)
+        self.board.pulseIn(9, HIGH)
+        self.assertEquals(self.mock_serial.timeout, 3)
+        self.assertEquals(self.board.rtt.srtt, None)
+
+    def test_late_response_drained(self):
+        from Arduino.arduino import Arduino
+        sr = StreamSerial([('51', '2\r\n'), ('600\r\n', '')])
+        board = Arduino(sr=sr)
+        self.assertEquals(board.analogRead(0), 600)
+        sr.push_line(0)
+        self.assertEquals(sr.stream, '')
+
+    def test_reply_length(self):
+        self.mock_serial.baudrate = 9600
+        self.board.rtt.update(0.01)
+        self.mock_serial.push_line(512)
+        self.board.analogRead(0)
+        self.assertAlmostEqual(self.mock_serial.timeout,
+                               0.05 + 20 * 10 / 9600.)
+
+    def test_sync_clock_after_timeout(self):
+        from Arduino.arduino import Arduino
+        sr = StreamSerial([('', '1000\r\n'), ('2000\r\n', ''),
+                           ('3000\r\n', '')])
+        board = Arduino(sr=sr)
+        board.rtt.update(0.001)
+        board.sync_clock(pings=3)
+        # Only the third ping is used, the second one follows a timeout.
+        self.assertEquals([p[0] for p in board.clock.points], [0.003])
+
+    def test_rtt_estimator(self):
+        from Arduino.arduino import RTTEstimator
+        rtt = RTTEstimator(max_timeout=2, min_timeout=0.01)
+        self.assertEquals(rtt.timeout, 2)
+        rtt.update(0.02)
+        self.assertAlmostEqual(rtt.timeout, 0.06)
+        for i in range(50):
+            rtt.update(0.02)
+        self.assertTrue(0.02 < rtt.timeout < 0.025)
+        rtt.update(10)
+        self.assertEquals(rtt.timeout, 2)
+
+
 class TestServos(ArduinoTestCase):
 
     def test_attach(self):
@@ -203,6 +377,12 @@ class TestServos(ArduinoTestCase):
         self.assertEquals(self.mock_serial.output[0],
             build_cmd_str('sva', (pin, servo_min, servo_max)))
 
+    def test_attach_timeout(self):
+        from Arduino.arduino import ArduinoTimeout
+        for i in range(3):
+            self.mock_serial.push_line('', term='')
+        self.assertRaises(ArduinoTimeout, self.board.Servos.attach, 10)
+
     def test_detach(self):
         from Arduino.arduino import build_cmd_str
         pin = 10
@@ -256,5 +436,828 @@ class TestServos(ArduinoTestCase):
             build_cmd_str("svr", (position,)))
 
 
+class TestTimestamps(ArduinoTestCase):
+
+    def test_enable(self):
+        from Arduino.arduino import build_cmd_str
+        self.board.enable_timestamps()
+        self.assertEquals(self.mock_serial.output[0],
+                          build_cmd_str('tsm', (1,)))
+        self.mock_serial.push_line('512 123456')
+        self.assertEquals(self.board.analogRead(0), 512)
+        self.assertEquals(self.board.last_timestamp, 123456)
+        self.mock_serial.push_line('1 123500')
+        self.assertEquals(self.board.digitalRead(2), 1)
+        self.mock_serial.push_line('230 124000')
+        self.assertEquals(self.board.pulseIn(3, HIGH), 230)
+        self.assertEquals(self.board.last_timestamp, 124000)
+
+    def test_sync_clock(self):
+        from Arduino.arduino import build_cmd_str
+        self.mock_serial.push_line(1000000)
+        self.mock_serial.push_line('')
+        self.assertTrue(self.board.sync_clock(pings=2) is not None)
+        self.assertEquals(self.mock_serial.output,
+                          [build_cmd_str('tm')] * 2)
+        self.board.last_timestamp = 1500000
+        host = self.board.clock.to_host(1000000)
+        self.assertAlmostEqual(self.board.last_sample_time - host, 0.5)
+
+    def test_clock_drift(self):
+        from Arduino.arduino import BoardClock
+        clock = BoardClock()
+        self.assertRaises(ValueError, clock.to_host, 0)
+        # The board clock runs 1% slow.
+        for t in range(10):
+            clock.sync(t * 990000, 100 + t)
+        self.assertAlmostEqual(clock.rate, 1 / 0.99)
+        self.assertAlmostEqual(clock.to_host(99000000), 200)
+
+    def test_clock_unwrap(self):
+        from Arduino.arduino import BoardClock
+        clock = BoardClock()
+        wrap = BoardClock.WRAP
+        self.assertEquals(clock.unwrap(wrap - 10), wrap - 10)
+        self.assertEquals(clock.unwrap(5), wrap + 5)
+        self.assertEquals(clock.unwrap(wrap - 5), wrap - 5)
+        self.assertEquals(clock.unwrap(3), wrap + 3)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestAcquire(ArduinoTestCase):
+
+    def test_acquire(self):
+        from Arduino.arduino import build_cmd_str
+        values = [1, 1023, 2, 1000, 3, 512]
+        self.mock_serial.push_bytes(struct.pack('<6H', *values))
+        self.mock_serial.push_line(0)
+        samples = self.board.acquire([0, 1], 3, 100)
+        self.assertEquals(samples.shape, (3, 2))
+        self.assertEquals(samples.dtype.itemsize, 2)
+        self.assertEquals(samples.tolist(), [[1, 1023], [2, 1000], [3, 512]])
+        self.assertEquals(self.board.last_acquire_late, 0)
+        self.assertEquals(self.mock_serial.output[0],
+                          build_cmd_str('acq', (10000, 3, 0, 1)))
+
+    def test_acquire_timeout(self):
+        self.mock_serial.push_bytes(struct.pack('<3H', 1, 2, 3))
+        self.assertRaises(IOError, self.board.acquire, [0, 1], 3, 100)
+
+    def test_command_after_acquire_timeout(self):
+        from Arduino.arduino import Arduino
+        samples = struct.pack('<6H', 1, 2, 3, 4, 5, 6).decode('latin-1')
+        # The end of the acquisition arrives after the read timed out.
+        sr = StreamSerial([(samples[:4], samples[4:] + '0\r\n'),
+                           ('512\r\n', '')])
+        board = Arduino(sr=sr)
+        self.assertRaises(IOError, board.acquire, [0, 1], 3, 100)
+        self.assertEquals(board.analogRead(0), 512)
+
+    def test_processing(self):
+        from Arduino.acquisition import to_volts, decimate, moving_average
+        samples = numpy.array([[0], [1023], [1023], [0], [1023]],
+                              dtype=numpy.uint16)
+        volts = to_volts(samples)
+        self.assertEquals(volts.dtype, numpy.float32)
+        self.assertAlmostEqual(volts[1, 0], 5.0, places=5)
+        self.assertEquals(decimate(samples, 2).tolist(),
+                          [[511.5], [511.5]])
+        data = numpy.arange(5, dtype=float).reshape(5, 1)
+        moving_average(data, 2, out=data)
+        self.assertEquals(data[:, 0].tolist(), [0, 0.5, 1.5, 2.5, 3.5])
+
+
+class TestMacros(ArduinoTestCase):
+
+    def test_upload(self):
+        from Arduino.arduino import build_cmd_str
+        steps = [('pinMode', 13, OUTPUT),
+                 ('digitalWrite', 13, HIGH),
+                 ('delayMicroseconds', 10),
+                 ('dw', 13, LOW),
+                 ('delay', 5),
+                 ('loop', 1, 3)]
+        self.mock_serial.push_line(len(steps))
+        self.assertTrue(self.board.Macros.upload(1, steps))
+        self.assertEquals(self.mock_serial.output, [
+            build_cmd_str('mcc', (1,)),
+            build_cmd_str('mca', (1, 3, 13, 1, 1, 13, 1, 6, 10, 0)),
+            build_cmd_str('mca', (1, 1, 13, 0, 5, 5, 0, 7, 2, 1)),
+            build_cmd_str('mcn', (1,))])
+        self.assertAlmostEqual(self.board.Macros.durations[1], 0.01503)
+
+    def test_upload_invalid(self):
+        self.assertRaises(ValueError, self.board.Macros.upload, 4, [])
+        self.assertRaises(ValueError, self.board.Macros.upload, 0,
+                          [('blink', 13)])
+        self.assertRaises(ValueError, self.board.Macros.upload, 0,
+                          [('delay', 1), ('loop', 1, 2)])
+        self.assertEquals(self.mock_serial.output, [])
+
+    def test_upload_out_of_range(self):
+        for step in [('delay', 40000), ('delay', -1), ('loop', 0, 40000),
+                     ('dw', 70000, HIGH), ('svw', 9, 90)]:
+            self.assertRaises(ValueError, self.board.Macros.upload, 0,
+                              [('delayMicroseconds', 1), step])
+        self.assertEquals(self.mock_serial.output, [])
+
+    def test_run(self):
+        from Arduino.arduino import build_cmd_str
+        self.mock_serial.push_line('mc OK')
+        self.assertTrue(self.board.Macros.run(2, repeat=5))
+        self.assertEquals(self.mock_serial.output[0],
+                          build_cmd_str('mcr', (2, 5)))
+
+    def test_run_invalidates_shadow(self):
+        from Arduino.arduino import Arduino
+        board = Arduino(sr=self.mock_serial, shadow=True)
+        board.digitalWrite(13, HIGH)
+        self.mock_serial.push_line(1)
+        board.Macros.upload(0, [('dw', 13, LOW)])
+        self.mock_serial.push_line('mc OK')
+        board.Macros.run(0, wait=False)
+        board.Macros.wait()
+        self.mock_serial.reset_mock()
+        board.digitalWrite(13, HIGH)
+        self.assertEquals(len(self.mock_serial.output), 1)
+
+    def test_run_holds_board(self):
+        import threading
+        self.mock_serial.push_line('mc OK')
+        self.mock_serial.push_line(512)
+        self.board.Macros.run(0, wait=False)
+        results = []
+        reader = threading.Thread(
+            target=lambda: results.append(self.board.analogRead(0)))
+        reader.start()
+        reader.join(0.1)
+        # The reading waits for the completion report to be read.
+        self.assertEquals(results, [])
+        self.assertTrue(self.board.Macros.wait())
+        reader.join()
+        self.assertEquals(results, [512])
+        self.assertFalse(self.board.lock.owned())
+
+    def test_run_from_other_thread(self):
+        import threading
+        self.mock_serial.push_line('mc OK')
+        self.mock_serial.push_line('mc OK')
+        self.board.Macros.run(0, wait=False)
+        results = []
+        runner = threading.Thread(
+            target=lambda: results.append(self.board.Macros.run(1)))
+        runner.start()
+        runner.join(0.1)
+        # The second run waits for the board, without taking the
+        # completion report of the first one.
+        self.assertEquals(results, [])
+        self.assertTrue(self.board.Macros.wait())
+        runner.join()
+        self.assertEquals(results, [True])
+        self.assertFalse(self.board.lock.owned())
+
+
+class TestWaveform(ArduinoTestCase):
+
+    def test_play_loop(self):
+        from Arduino.arduino import build_cmd_str
+        samples = list(range(0, 256, 8)) + [300, -1]
+        self.board.Waveform.play(samples, 1000, 9, loop=True)
+        hex_samples = ''.join('{0:02x}'.format(v) for v in range(0, 256, 8))
+        self.assertEquals(self.mock_serial.output, [
+            build_cmd_str('wvx'),
+            build_cmd_str('wvl', (0, hex_samples[:48])),
+            build_cmd_str('wvl', (24, hex_samples[48:] + 'ff00')),
+            build_cmd_str('wvf', (0, 34)),
+            build_cmd_str('wvp', (1000, 1, 9))])
+
+    def test_play_stream(self):
+        from Arduino.arduino import build_cmd_str
+        samples = bytearray(range(200))
+        # Half 0 is free on the first poll, half 1 on the second one,
+        # then playback ends.
+        self.mock_serial.push_line('1 0 64')
+        self.mock_serial.push_line('1 64 0')
+        self.mock_serial.push_line('0 0 0')
+        self.assertTrue(self.board.Waveform.play(samples, 10000, [5, 6]))
+        fills = [cmd for cmd in self.mock_serial.output if '@wvf' in cmd]
+        self.assertEquals(fills, [build_cmd_str('wvf', (0, 64)),
+                                  build_cmd_str('wvf', (1, 64)),
+                                  build_cmd_str('wvf', (0, 64)),
+                                  build_cmd_str('wvf', (1, 8))])
+        self.assertEquals(self.board.Waveform.underruns, 0)
+
+    def test_underrun(self):
+        self.mock_serial.push_line('0 0 0')
+        self.mock_serial.push_line('0 0 0')
+        self.assertTrue(self.board.Waveform.play(bytearray(150), 10000, 5))
+        plays = [cmd for cmd in self.mock_serial.output if '@wvp' in cmd]
+        self.assertEquals(len(plays), 2)
+        self.assertEquals(self.board.Waveform.underruns, 1)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.board.Waveform.play,
+                          [], 100, 9)
+        self.assertRaises(ValueError, self.board.Waveform.play,
+                          bytearray(129), 100, 9, loop=True)
+        self.assertRaises(ValueError, self.board.Waveform.play,
+                          [1], 100, [3, 5, 6, 9, 10])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_samples(self):
+        from Arduino.arduino import pwm_samples
+        samples = numpy.array([0, 128, 255], dtype=numpy.uint8)
+        self.assertEquals(pwm_samples(samples), bytearray([0, 128, 255]))
+
+
+class TestConnect(unittest.TestCase):
+
+    def test_wait_for_board(self):
+        from Arduino.arduino import wait_for_board, build_cmd_str
+        mock_serial = MockSerial(9600, '/dev/ttyACM0', timeout=2)
+        # The board does not answer while its bootloader runs.
+        mock_serial.push_line('', term='')
+        mock_serial.push_line('', term='')
+        mock_serial.push_line('version')
+        self.assertTrue(wait_for_board(mock_serial, poll=0.01))
+        self.assertEquals(mock_serial.output, [build_cmd_str('version')] * 3)
+        self.assertEquals(mock_serial.timeout, 2)
+
+    def test_wait_for_board_no_answer(self):
+        from Arduino.arduino import wait_for_board
+        mock_serial = MockSerial(9600, '/dev/ttyACM0')
+        for i in range(3):
+            mock_serial.push_line('', term='')
+        self.assertFalse(wait_for_board(mock_serial, wait=0))
+
+    def test_clear_hupcl(self):
+        from Arduino.arduino import clear_hupcl
+        try:
+            import pty
+            import termios
+        except ImportError:
+            self.skipTest('no POSIX terminals')
+        master, slave = pty.openpty()
+        try:
+            port = MockSerial(9600, '/dev/pts')
+            port.fileno = lambda: slave
+            self.assertTrue(clear_hupcl(port))
+            self.assertFalse(termios.tcgetattr(slave)[2] & termios.HUPCL)
+        finally:
+            os.close(master)
+            os.close(slave)
+        self.assertFalse(clear_hupcl(MockSerial(9600, '/dev/ttyACM0')))
+
+    def test_lazy_port_discovery(self):
+        import subprocess
+        import sys
+        code = ("import sys, Arduino; "
+                "print('serial.tools.list_ports' in sys.modules)")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEquals(out.strip(), b'False')
+
+
+class TestShadow(unittest.TestCase):
+
+    def setUp(self):
+        from Arduino.arduino import Arduino
+        self.mock_serial = MockSerial(9600, '/dev/ttyACM0')
+        self.board = Arduino(sr=self.mock_serial, shadow=True)
+
+    def test_digitalWrite(self):
+        from Arduino.arduino import build_cmd_str
+        pin = 9
+        self.board.digitalWrite(pin, HIGH)
+        self.board.digitalWrite(pin, HIGH)
+        self.board.digitalWrite(pin, LOW)
+        self.assertEquals(self.mock_serial.output,
+            [build_cmd_str('dw', (pin,)), build_cmd_str('dw', (-pin,))])
+
+    def test_analogWrite_after_digitalWrite(self):
+        from Arduino.arduino import build_cmd_str
+        pin = 9
+        self.board.analogWrite(pin, 255)
+        self.board.digitalWrite(pin, LOW)
+        self.board.analogWrite(pin, 255)
+        self.board.analogWrite(pin, 255)
+        self.assertEquals(len(self.mock_serial.output), 3)
+
+    def test_pinMode(self):
+        pin = 9
+        self.board.pinMode(pin, OUTPUT)
+        self.board.digitalWrite(pin, HIGH)
+        self.board.pinMode(pin, OUTPUT)
+        self.board.pinMode(pin, INPUT)
+        # The output state is unknown after a mode change.
+        self.board.digitalWrite(pin, HIGH)
+        self.assertEquals(len(self.mock_serial.output), 4)
+
+    def test_invalidate(self):
+        pin = 9
+        self.board.digitalWrite(pin, HIGH)
+        self.board.invalidate_shadow()
+        self.board.digitalWrite(pin, HIGH)
+        self.board.invalidate_shadow(pin)
+        self.board.digitalWrite(pin, HIGH)
+        self.board.invalidate_shadow(pin + 1)
+        self.board.digitalWrite(pin, HIGH)
+        self.assertEquals(len(self.mock_serial.output), 3)
+
+    def test_servo_write(self):
+        pin = 10
+        self.mock_serial.push_line(0)
+        self.board.Servos.attach(pin)
+        self.mock_serial.reset_mock()
+        self.board.Servos.write(pin, 90)
+        self.board.Servos.write(pin, 90)
+        self.board.Servos.writeMicroseconds(pin, 1500)
+        self.board.Servos.write(pin, 90)
+        self.assertEquals(len(self.mock_serial.output), 3)
+
+
+class TestReadCache(unittest.TestCase):
+
+    def setUp(self):
+        from Arduino import Arduino, ReadCache
+        self.mock_serial = MockSerial(9600, '/dev/ttyACM0')
+        self.cache = ReadCache(max_age=60, pin_max_age={('ar', 1): 0})
+        self.board = Arduino(sr=self.mock_serial, read_cache=self.cache)
+
+    def test_hit(self):
+        self.mock_serial.push_line(512)
+        self.assertEquals(self.board.analogRead(0), 512)
+        self.assertEquals(self.board.analogRead(0), 512)
+        self.assertEquals(len(self.mock_serial.output), 1)
+        self.assertEquals(self.cache.stats(),
+                          dict(hits=1, shared=0, misses=1))
+
+    def test_pin_max_age(self):
+        self.mock_serial.push_line(10)
+        self.mock_serial.push_line(20)
+        self.assertEquals(self.board.analogRead(1), 10)
+        self.assertEquals(self.board.analogRead(1), 20)
+        self.assertEquals(len(self.mock_serial.output), 2)
+
+    def test_digitalWrite_invalidates(self):
+        pin = 9
+        self.mock_serial.push_line(READ_LOW)
+        self.mock_serial.push_line(READ_HIGH)
+        self.assertEquals(self.board.digitalRead(pin), READ_LOW)
+        self.board.digitalWrite(pin, HIGH)
+        self.assertEquals(self.board.digitalRead(pin), READ_HIGH)
+
+    def test_shared_request(self):
+        import threading
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def fetch():
+            started.set()
+            release.wait()
+            return 42
+
+        def reader():
+            results.append(self.cache.get(('ar', 5), fetch))
+
+        first = threading.Thread(target=reader)
+        first.start()
+        started.wait()
+        second = threading.Thread(target=reader)
+        second.start()
+        release.set()
+        first.join()
+        second.join()
+        self.assertEquals(results, [42, 42])
+        self.assertEquals(self.cache.misses, 1)
+
+    def _read_while_locked(self, pin_a, pin_b):
+        import threading
+        import time
+        locked = threading.Event()
+        results = {}
+
+        def holder():
+            with self.board.lock:
+                locked.set()
+                while not self.board.lock._waiting:
+                    time.sleep(0.001)
+                results['a'] = self.board.analogRead(pin_a)
+
+        def reader():
+            locked.wait()
+            results['b'] = self.board.analogRead(pin_b)
+
+        self.mock_serial.push_line(10)
+        self.mock_serial.push_line(20)
+        threads = [threading.Thread(target=holder),
+                   threading.Thread(target=reader)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        return results
+
+    def test_read_while_board_locked(self):
+        self.assertEquals(self._read_while_locked(0, 1), dict(a=10, b=20))
+
+    def test_same_pin_while_board_locked(self):
+        # The reader's request for pin 0 is pending on the board lock.
+        self.assertEquals(self._read_while_locked(0, 0), dict(a=10, b=20))
+
+
+class TestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'capture.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_record(self):
+        from Arduino.arduino import Arduino, build_cmd_str
+        from Arduino.recorder import read_capture
+        mock_serial = MockSerial(9600, '/dev/ttyACM0')
+        board = Arduino(sr=mock_serial, record=self.path)
+        mock_serial.push_line(512)
+        self.assertEquals(board.analogRead(3), 512)
+        board.close()
+        records = list(read_capture(self.path))
+        self.assertEquals([r[1] for r in records], ['W', 'R'])
+        self.assertEquals(records[0][3], build_cmd_str('ar', (3,)))
+        self.assertEquals(records[1][3], '512\r\n')
+        self.assertTrue(records[0][2] <= records[1][2])
+
+    def test_replay(self):
+        from Arduino.arduino import Arduino
+        from Arduino.recorder import ReplaySerial
+        mock_serial = MockSerial(9600, '/dev/ttyACM0')
+        board = Arduino(sr=mock_serial, record=self.path)
+        mock_serial.push_line(1)
+        mock_serial.push_line(700)
+        board.digitalRead(4)
+        board.analogRead(2)
+        board.close()
+        board = Arduino(sr=ReplaySerial(self.path, speed=None, strict=True))
+        self.assertEquals(board.digitalRead(4), 1)
+        self.assertEquals(board.analogRead(2), 700)
+
+    def test_replay_strict(self):
+        from Arduino.arduino import Arduino, build_cmd_str
+        from Arduino.recorder import ReplaySerial
+        mock_serial = MockSerial(9600, '/dev/ttyACM0')
+        board = Arduino(sr=mock_serial, record=self.path)
+        mock_serial.push_line(700)
+        board.analogRead(2)
+        board.close()
+        replay = ReplaySerial(self.path, strict=True)
+        self.assertRaises(ValueError, replay.write, build_cmd_str('ar', (5,)))
+
+    def test_replay_sessions(self):
+        from Arduino.arduino import Arduino
+        from Arduino.recorder import ReplaySerial
+        for value in (10, 20):
+            mock_serial = MockSerial(9600, '/dev/ttyACM0')
+            board = Arduino(sr=mock_serial, record=self.path)
+            mock_serial.push_line(value)
+            board.analogRead(0)
+            board.close()
+        board = Arduino(sr=ReplaySerial(self.path, speed=None, session=0))
+        self.assertEquals(board.analogRead(0), 10)
+        board = Arduino(sr=ReplaySerial(self.path, speed=None))
+        self.assertEquals(board.analogRead(0), 20)
+
+    def test_replay_read_size(self):
+        from Arduino.arduino import Arduino
+        from Arduino.recorder import ReplaySerial
+        mock_serial = MockSerial(9600, '/dev/ttyACM0')
+        board = Arduino(sr=mock_serial, record=self.path)
+        mock_serial.push_bytes(b'\x01\x02\x03')
+        board.sr.read(3)
+        board.close()
+        replay = ReplaySerial(self.path, speed=None)
+        self.assertEquals(replay.read(2), b'\x01\x02')
+        self.assertEquals(replay.read(2), b'\x03')
+        self.assertEquals(replay.read(2), b'')
+
+    def test_replay_timeout(self):
+        import time
+        from Arduino.arduino import Arduino, ArduinoTimeout
+        from Arduino.recorder import ReplaySerial
+        mock_serial = MockSerial(9600, '/dev/ttyACM0')
+        board = Arduino(sr=mock_serial, record=self.path, retries=0)
+        mock_serial.push_line('', term='')
+        self.assertRaises(ArduinoTimeout, board.analogRead, 0)
+        board.close()
+        board = Arduino(sr=ReplaySerial(self.path, speed=None), retries=0)
+        start = time.time()
+        self.assertRaises(ArduinoTimeout, board.analogRead, 0)
+        # The timed out read is not drained by waiting for an idle link.
+        self.assertTrue(time.time() - start < 0.5)
+
+
+class TestDataLogger(unittest.TestCase):
+
+    def setUp(self):
+        from Arduino.arduino import Arduino
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'log.bin')
+        self.mock_serial = MockSerial(9600, '/dev/ttyACM0')
+        self.board = Arduino(sr=self.mock_serial)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_log(self):
+        import time
+        from Arduino.datalogger import (
+            DataLogger, read_index, read_log, wall_times)
+        for value in range(10):
+            self.mock_serial.push_line(value * 100)
+        logger = DataLogger(self.board, self.path, [0, 1], chunk_rows=2,
+                            max_rows=5)
+        logger.start()
+        self.assertTrue(logger.wait(5))
+        self.assertEquals(logger.rows, 5)
+        log = read_log(self.path)
+        self.assertEquals(log['pins'], [0, 1])
+        self.assertEquals(log['rows']['values'].tolist(),
+                          [[0, 100], [200, 300], [400, 500], [600, 700],
+                           [800, 900]])
+        self.assertTrue((numpy.diff(log['rows']['t']) >= 0).all())
+        self.assertEquals([e[1] for e in read_index(self.path)], [2, 2, 1])
+        times = wall_times(self.path)
+        self.assertEquals(times.shape, (5,))
+        self.assertTrue(abs(times[-1] - time.time()) < 5)
+
+    def test_read_errors(self):
+        from Arduino.arduino import ArduinoTimeout
+        from Arduino.datalogger import DataLogger
+        values = [ArduinoTimeout('timeout'), 7, 8]
+
+        def read(pin):
+            value = values.pop(0)
+            if isinstance(value, Exception):
+                raise value
+            return value
+        logger = DataLogger(self.board, self.path, [3], read=read,
+                            max_rows=2)
+        logger.start()
+        self.assertTrue(logger.wait(5))
+        self.assertEquals((logger.rows, logger.errors), (2, 1))
+
+    def test_pins_mismatch(self):
+        from Arduino.datalogger import DataLogger
+        logger = DataLogger(self.board, self.path, [0], read=lambda pin: 1,
+                            max_rows=1)
+        logger.start()
+        logger.wait(5)
+        logger = DataLogger(self.board, self.path, [1])
+        self.assertRaises(ValueError, logger.start)
+
+
+class TestPorts(ArduinoTestCase):
+
+    def test_portWrite(self):
+        from Arduino.arduino import build_cmd_str
+        self.board.portWrite('B', 0x1ff, 0x0f)
+        self.assertEquals(self.mock_serial.output[0],
+                          build_cmd_str('pw', (2, 0xff, 0x0f)))
+        self.assertRaises(ValueError, self.board.portWrite, 'AB', 0)
+
+    def test_portRead(self):
+        from Arduino.arduino import build_cmd_str
+        self.mock_serial.push_line(0x21)
+        self.assertEquals(self.board.portRead(4), 0x21)
+        self.assertEquals(self.mock_serial.output[0],
+                          build_cmd_str('pr', (4,)))
+
+    def test_portRead_no_port(self):
+        self.mock_serial.push_line(-1)
+        self.assertRaises(ValueError, self.board.portRead, 'E')
+
+    def test_pin_group(self):
+        from Arduino.arduino import PinGroup, build_cmd_str
+        # Uno: pins 6 and 7 are PD6 and PD7, pin 8 is PB0.
+        for line in ('4 64', '4 128', '2 1'):
+            self.mock_serial.push_line(line)
+        bus = PinGroup(self.board, [6, 7, 8])
+        bus.write(0b101)
+        self.assertEquals(self.mock_serial.output[3:], [
+            build_cmd_str('pw', (2, 1, 1)),
+            build_cmd_str('pw', (4, 64, 192))])
+        self.mock_serial.reset_mock()
+        bus.write(0b010)
+        self.assertEquals(len(self.mock_serial.output), 2)
+        self.mock_serial.push_line(0)
+        self.mock_serial.push_line(0xff)
+        self.assertEquals(bus.read(), 0b011)
+
+    def test_pin_group_shadow(self):
+        from Arduino.arduino import Arduino, PinGroup
+        board = Arduino(sr=self.mock_serial, shadow=True)
+        board.digitalWrite(8, HIGH)
+        self.mock_serial.push_line('2 1')
+        PinGroup(board, [8]).write(0)
+        self.mock_serial.reset_mock()
+        board.digitalWrite(8, HIGH)
+        self.assertEquals(len(self.mock_serial.output), 1)
+
+    def test_pin_not_on_port(self):
+        from Arduino.arduino import PinGroup
+        self.mock_serial.push_line('0 0')
+        self.assertRaises(ValueError, PinGroup(self.board, [99]).write, 1)
+
+
+class TestBoardStats(ArduinoTestCase):
+
+    def test_board_stats(self):
+        from Arduino.arduino import build_cmd_str
+        self.mock_serial.push_line('2000 10 900 1 2 0 812 2')
+        self.mock_serial.push_line('ar 5 600')
+        self.mock_serial.push_line('st 1 3000')
+        stats = self.board.board_stats(reset=True)
+        self.assertEquals(self.mock_serial.output,
+                          [build_cmd_str('st', (1,))])
+        self.assertEquals(stats['loop_mean_us'], 5.0)
+        self.assertEquals(stats['loop_max_us'], 900)
+        self.assertEquals(stats['rx_overflows'], 1)
+        self.assertEquals(stats['parse_errors'], 2)
+        self.assertEquals(stats['free_ram'], 812)
+        self.assertEquals(stats['commands'],
+                          {'ar': (5, 600), 'st': (1, 3000)})
+
+    def test_board_stats_malformed(self):
+        self.mock_serial.push_line('garbage')
+        self.assertEquals(self.board.board_stats(), None)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_priority_order(self):
+        import threading
+        import time
+        from Arduino.scheduler import BULK, CONTROL, PriorityLock
+        lock = PriorityLock()
+        order = []
+
+        def run(priority):
+            with lock(priority):
+                order.append(priority)
+        lock.acquire()
+        threads = []
+        for priority in (BULK, CONTROL):
+            thread = threading.Thread(target=run, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            while len(lock._waiting) < len(threads):
+                time.sleep(0.001)
+        lock.release()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(order, [CONTROL, BULK])
+
+    def test_reentrant(self):
+        from Arduino.scheduler import PriorityLock
+        lock = PriorityLock()
+        with lock:
+            with lock:
+                self.assertTrue(lock.owned())
+            self.assertTrue(lock.owned())
+        self.assertFalse(lock.owned())
+        self.assertRaises(RuntimeError, lock.release)
+
+    def test_rate_limit(self):
+        from Arduino.scheduler import TokenBucket
+        bucket = TokenBucket(10, burst=2)
+        self.assertEquals(bucket.take(), 0)
+        self.assertEquals(bucket.take(), 0)
+        self.assertTrue(0 < bucket.take() <= 0.1)
+
+    def test_command_classes(self):
+        from Arduino.scheduler import (BULK, CONTROL, SENSING,
+                                       Scheduler)
+        scheduler = Scheduler({BULK: 5})
+        self.assertEquals(scheduler.priority('svw'), CONTROL)
+        self.assertEquals(scheduler.priority('ar'), SENSING)
+        self.assertEquals(scheduler.priority('eed'), BULK)
+        self.assertEquals(list(scheduler.buckets), [BULK])
+
+
+class TestBulk(ArduinoTestCase):
+
+    def test_melody_chunks(self):
+        from Arduino.arduino import build_cmd_str
+        notes = ['C4'] * 6
+        self.board.Melody(9, notes, [64] * 6)
+        self.assertEquals(self.mock_serial.output, [
+            build_cmd_str('to', [4, 9] + [262] * 4 + [64] * 4),
+            build_cmd_str('to', [2, 9] + [262] * 2 + [64] * 2),
+            build_cmd_str('nto', (9,))])
+
+    def test_melody_invalid_durations(self):
+        self.assertEquals(self.board.Melody(9, ['C4', 'D4'], [4, 0]), -1)
+        self.assertEquals(self.board.Melody(9, ['C4'], ['4']), -1)
+        self.assertEquals(self.mock_serial.output, [])
+
+    def test_eeprom_dump(self):
+        from Arduino.arduino import build_cmd_str
+        self.board.EEPROM.DUMP_CHUNK = 2
+        self.mock_serial.push_line('0A0B')
+        self.mock_serial.push_line('FF')
+        self.assertEquals(self.board.EEPROM.dump(4, 3),
+                          bytearray([10, 11, 255]))
+        self.assertEquals(self.mock_serial.output, [
+            build_cmd_str('eed', (4, 2)), build_cmd_str('eed', (6, 1))])
+
+    def test_eeprom_dump_timeout(self):
+        self.mock_serial.baudrate = 9600
+        self.board.rtt.update(0.01)
+        self.mock_serial.push_line('00' * 32)
+        self.board.EEPROM.dump(0, 32)
+        self.assertAlmostEqual(self.mock_serial.timeout,
+                               0.05 + 66 * 10 / 9600.)
+
+    def test_eeprom_dump_malformed(self):
+        self.mock_serial.push_line('0A')
+        self.assertRaises(IOError, self.board.EEPROM.dump, 0, 2)
+
+
+class TestBindings(ArduinoTestCase):
+
+    def test_install(self):
+        from Arduino.arduino import build_cmd_str
+        self.mock_serial.push_line('bd OK')
+        self.assertTrue(self.board.Bindings.install(
+            0, ('analog', 0), ('pwm', 9), deadband=2))
+        self.assertEquals(self.mock_serial.output, [
+            build_cmd_str('bdi', (0, 0, 0, 0, 9, 0)),
+            build_cmd_str('bdt', (0, 0, 1023, 0, 255, 2)),
+            build_cmd_str('bde', (0, 1))])
+
+    def test_install_digital_pid(self):
+        from Arduino.arduino import build_cmd_str
+        self.mock_serial.push_line('bd OK')
+        self.board.Bindings.install(
+            1, ('analog', 2), ('digital', 7), in_range=(-100, 100),
+            thresholds=(20, -20), pid=(512, 0.5, 0.1, 0), period_ms=10)
+        self.assertEquals(self.mock_serial.output[:4], [
+            build_cmd_str('bdi', (1, 0, 2, 2, 7, 10)),
+            build_cmd_str('bdh', (1, 20, -20)),
+            build_cmd_str('bdt', (1, -100, 100, 0, 1, 0)),
+            build_cmd_str('bdp', (1, 512, 0.5, 0.1, 0))])
+
+    def test_install_pid_precision(self):
+        from Arduino.arduino import build_cmd_str
+        self.mock_serial.push_line('bd OK')
+        self.board.Bindings.install(
+            0, ('analog', 0), ('pwm', 9),
+            pid=(1000, 1 / 7., 1 / 70., 1 / 700.))
+        self.assertEquals(self.mock_serial.output[2], build_cmd_str(
+            'bdp', (0, 1000, '0.142857', '0.0142857', '0.00142857')))
+
+    def test_install_too_long(self):
+        self.assertRaises(ValueError, self.board.Bindings.install,
+                          0, ('analog', 0), ('pwm', 9),
+                          in_range=(-10 ** 30, 10 ** 30))
+        self.assertEquals(self.mock_serial.output, [])
+
+    def test_install_errors(self):
+        bindings = self.board.Bindings
+        self.assertRaises(ValueError, bindings.install, 4, ('analog', 0),
+                          ('pwm', 9))
+        self.assertRaises(ValueError, bindings.install, 0, ('analog', 0),
+                          ('servo', 9))
+        self.assertRaises(ValueError, bindings.install, 0, ('touch', 0),
+                          ('pwm', 9))
+
+    def test_shadow(self):
+        from Arduino.arduino import Arduino
+        board = Arduino(sr=self.mock_serial, shadow=True)
+        board.analogWrite(9, 10)
+        self.mock_serial.push_line('bd OK')
+        board.Bindings.install(0, ('analog', 0), ('pwm', 9))
+        board.Bindings.remove(0)
+        self.mock_serial.reset_mock()
+        board.analogWrite(9, 10)
+        self.assertEquals(len(self.mock_serial.output), 1)
+
+    def test_list(self):
+        self.mock_serial.push_line(2)
+        self.mock_serial.push_line('0 1 0 0 0 9 511 128')
+        self.mock_serial.push_line('3 0 1 4 2 7 -1 -1')
+        bindings = self.board.Bindings.list()
+        self.assertEquals(bindings[0]['input'], ('analog', 0))
+        self.assertEquals(bindings[0]['output'], ('pwm', 9))
+        self.assertEquals(bindings[0]['last_output'], 128)
+        self.assertEquals(bindings[1]['enabled'], False)
+        self.assertEquals(bindings[1]['output'], ('digital', 7))
+
+
 if __name__ == '__main__':
     unittest.main()